@@ -1,45 +1,19 @@
-import requests 
-import pandas as pd
-import csv
-import time
-import glob
-import os
-import pandas as sd
+import os, sys
+# Same bootstrap as the notebooks, so python customscripts/apiScript.py finds
+# the customscripts package
+currentdir = os.path.dirname(os.path.realpath(os.path.abspath(__file__)))
+scriptsdir = os.path.dirname(currentdir)
+if scriptsdir not in sys.path:
+    sys.path.append(scriptsdir)
+
+from customscripts import comtrade
 path = r'C:\Users\Sreejit\segdata'
 
 cList= ["842", "276", "392", "344", "826" , "381", "528", "699" , "484", "124"]
-j=0
-nm=0
-while j < len(cList):
-    time.sleep(1)
-    url="http://comtrade.un.org/api/get?r="+ cList[j]+"&px=HS&ps=2019&p=ALL&cc=TOTAL&type=C&freq=M&fmt=csv&rg=1,2"
-    df = pd.read_csv(url) 
-    df.to_csv(os.path.join(path,r'outcom'+str(nm)+'.csv'))
-    nm=nm+1
-    j=j+1
+results = comtrade.download(cList, ["2019"], path, flows=(1, 2), rate=1.0, concurrency=4,
+                           cache_dir=os.path.join(path, ".http_cache"))
+for result in results:
+    if result["error"] is not None:
+        print(result["partition"], ":", result["error"])
     
-path =  r'C:\Users\Sreejit\segdata'
-all_files = glob.glob(path + "/*.csv")
-
-li = []
-
-for filename in all_files:
-    df = sd.read_csv(filename, index_col=None, header=0)
-    li.append(df)
-
-frame = sd.concat(li, axis=0, ignore_index=True)
-frame.to_csv(os.path.join(path,r'final2.csv'))
-
-
-
-path =  r'C:\Users\Sreejit\segdata'
-all_files = glob.glob(path + "/*.csv")
-
-li = []
-
-for filename in all_files:
-    df = sd.read_csv(filename, index_col=None, header=0)
-    li.append(df)
-
-frame = sd.concat(li, axis=0, ignore_index=True)
-frame.to_csv(os.path.join(path,r'final2.csv'))
\ No newline at end of file
+comtrade.merge_shards(comtrade.get_shard_paths(path), os.path.join(path, "dataset"))
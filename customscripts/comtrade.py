@@ -0,0 +1,352 @@
+import asyncio
+import csv
+import datetime
+import hashlib
+import os
+import random
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import requests
+from requests.adapters import HTTPAdapter
+
+from customscripts import http_cache
+from customscripts import schema
+
+COMTRADE_BASE_URL = "http://comtrade.un.org/api/get"
+
+# Query parameters shared by every request, the per-request ones (r, ps, rg)
+# are filled in by build_url
+DEFAULT_QUERY = {
+    "px": "HS",
+    "p": "ALL",
+    "cc": "TOTAL",
+    "type": "C",
+    "freq": "M",
+    "fmt": "csv",
+}
+
+# rg=1 are imports, rg=2 exports
+TRADE_FLOWS = (1, 2)
+
+# Comtrade answers 409 when the guest rate limit is hit
+RETRY_STATUSES = {409, 429, 500, 502, 503, 504}
+
+CHUNK_SIZE = 64 * 1024
+
+MANIFEST_NAME = "manifest.csv"
+MANIFEST_COLUMNS = ["reporter", "period", "flow", "checksum", "fetched_at"]
+
+DATASET_PARTITION_COLUMNS = ["Reporter ISO", "Year"]
+
+Partition = namedtuple("Partition", ["reporter", "period", "flow"])
+
+
+class TokenBucket():
+    # Hands out `rate` tokens per second on average, with bursts of at most
+    # `capacity` requests. Shared by all the download tasks of one run.
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = None
+
+    async def acquire(self):
+        # The lock is created lazily so it binds to the running event loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class DownloadError(Exception):
+    pass
+
+
+# Transient failures worth another attempt, DownloadError covers RETRY_STATUSES
+RETRY_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    DownloadError,
+)
+
+
+def build_url(partition, base_url=COMTRADE_BASE_URL, query=None):
+    params = dict(DEFAULT_QUERY)
+    if query:
+        params.update(query)
+    params.update({"r": partition.reporter, "ps": partition.period, "rg": partition.flow})
+    return f"{base_url}?{urlencode(params, safe=',')}"
+
+
+def partition_path(out_dir, partition):
+    return os.path.join(out_dir, f"{partition.reporter}_{partition.period}_{partition.flow}.csv")
+
+
+def get_monthly_periods(years):
+    return [f"{year}{month:02d}" for year in years for month in range(1, 13)]
+
+
+def get_partitions(reporters, periods, flows=TRADE_FLOWS):
+    return [Partition(str(r), str(p), int(f)) for r in reporters for p in periods for f in flows]
+
+
+def make_session(pool_size=4, cache_dir=None, cache_ttl=http_cache.DEFAULT_TTL,
+                 cache_max_bytes=http_cache.DEFAULT_MAX_BYTES):
+    # With a `cache_dir` responses are served from the local HTTP cache
+    # until they expire, see http_cache.cached_session
+    if cache_dir is not None:
+        return http_cache.cached_session(cache_dir=cache_dir, ttl=cache_ttl, max_bytes=cache_max_bytes,
+                                         pool_size=pool_size)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _stream_to_file(session, url, path, timeout):
+    # Runs in a worker thread: the body is written to disk as it arrives and
+    # only renamed into place once complete, so a crash never leaves a
+    # truncated file under the final name
+    tmp_path = path + ".part"
+    digest = hashlib.sha256()
+    with session.get(url, stream=True, timeout=timeout) as response:
+        if response.status_code in RETRY_STATUSES:
+            raise DownloadError(f"HTTP {response.status_code} for {url}")
+        response.raise_for_status()
+        with open(tmp_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                digest.update(chunk)
+    os.replace(tmp_path, path)
+    return digest.hexdigest()
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _period_end(period):
+    # First instant after the period: "2019" -> 2020-01-01, "201902" -> 2019-03-01
+    year = int(period[:4])
+    if len(period) == 4:
+        return datetime.datetime(year + 1, 1, 1)
+    month = int(period[4:6])
+    if month == 12:
+        return datetime.datetime(year + 1, 1, 1)
+    return datetime.datetime(year, month + 1, 1)
+
+
+class Manifest():
+    # Append-only log of completed partitions kept next to the downloaded
+    # files. Every finished download appends one line, so after a crash the
+    # next run knows exactly what is already on disk. The last line for a
+    # partition wins.
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.path = os.path.join(out_dir, MANIFEST_NAME)
+        self.entries = {}
+        if os.path.exists(self.path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, newline="") as f:
+            for row in csv.DictReader(f):
+                try:
+                    partition = Partition(row["reporter"], row["period"], int(row["flow"]))
+                    fetched_at = datetime.datetime.fromisoformat(row["fetched_at"])
+                except (KeyError, TypeError, ValueError):
+                    # A torn last line from an interrupted run
+                    continue
+                self.entries[partition] = {"checksum": row["checksum"], "fetched_at": fetched_at}
+
+    def is_fresh(self, partition, max_age=None, verify=True, now=None):
+        # A partition is stale when it is missing on disk, its content does
+        # not match the recorded checksum, it is older than `max_age`, or it
+        # was fetched before its period was over (so later months/revisions
+        # may still be missing from it)
+        entry = self.entries.get(partition)
+        path = partition_path(self.out_dir, partition)
+        if entry is None or not os.path.exists(path):
+            return False
+        now = now or datetime.datetime.utcnow()
+        if max_age is not None and now - entry["fetched_at"] > max_age:
+            return False
+        if entry["fetched_at"] < _period_end(partition.period):
+            return False
+        if verify and file_checksum(path) != entry["checksum"]:
+            return False
+        return True
+
+    def record(self, partition, checksum, fetched_at=None):
+        fetched_at = fetched_at or datetime.datetime.utcnow()
+        write_header = not os.path.exists(self.path)
+        with open(self.path, "a", newline="") as f:
+            writer = csv.writer(f)
+            if write_header:
+                writer.writerow(MANIFEST_COLUMNS)
+            writer.writerow([partition.reporter, partition.period, partition.flow, checksum,
+                             fetched_at.isoformat()])
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[partition] = {"checksum": checksum, "fetched_at": fetched_at}
+
+
+async def _fetch(partition, session, bucket, semaphore, executor, manifest, base_url, query, max_retries, backoff, timeout):
+    url = build_url(partition, base_url, query)
+    path = partition_path(manifest.out_dir, partition)
+    loop = asyncio.get_event_loop()
+    error = None
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            # Exponential backoff with jitter so retries of different
+            # partitions don't hit the API at the same instant
+            await asyncio.sleep(backoff * 2 ** (attempt - 1) * (1 + random.random()))
+        async with semaphore:
+            await bucket.acquire()
+            try:
+                checksum = await loop.run_in_executor(executor, _stream_to_file, session, url, path, timeout)
+            except RETRY_ERRORS as e:
+                error = e
+                continue
+            except requests.RequestException as e:
+                # Anything else, e.g. a 400/404, fails the same way every time
+                error = e
+                break
+        manifest.record(partition, checksum)
+        return {"partition": partition, "path": path, "skipped": False, "error": None}
+    return {"partition": partition, "path": None, "skipped": False, "error": error}
+
+
+async def download_all(reporters, periods, out_dir, flows=TRADE_FLOWS, base_url=COMTRADE_BASE_URL, query=None,
+                       rate=1.0, burst=1, concurrency=4, max_retries=5, backoff=1.0, timeout=60, session=None,
+                       max_age=None, refresh=False, verify=True, cache_dir=None,
+                       cache_ttl=http_cache.DEFAULT_TTL, cache_max_bytes=http_cache.DEFAULT_MAX_BYTES):
+    # Fans out over reporters x periods x flows. `rate` is in requests per
+    # second, `concurrency` bounds the number of responses in flight.
+    # Partitions already in the manifest and still fresh are skipped unless
+    # `refresh` is set, so an interrupted run resumes where it stopped.
+    # Failed partitions are reported in the result instead of aborting the run.
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = Manifest(out_dir)
+    partitions = get_partitions(reporters, periods, flows)
+    skipped = []
+    if not refresh:
+        skipped = [p for p in partitions if manifest.is_fresh(p, max_age=max_age, verify=verify)]
+        skipped_set = set(skipped)
+        partitions = [p for p in partitions if p not in skipped_set]
+    if session is None:
+        session = make_session(concurrency, cache_dir, cache_ttl, cache_max_bytes)
+    bucket = TokenBucket(rate, burst)
+    semaphore = asyncio.Semaphore(concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        tasks = [
+            _fetch(p, session, bucket, semaphore, executor, manifest, base_url, query, max_retries, backoff, timeout)
+            for p in partitions
+        ]
+        results = await asyncio.gather(*tasks)
+    skipped_results = [
+        {"partition": p, "path": partition_path(out_dir, p), "skipped": True, "error": None} for p in skipped
+    ]
+    return skipped_results + list(results)
+
+
+def download(reporters, periods, out_dir, **kwargs):
+    # Blocking wrapper for scripts. Inside a notebook the event loop is
+    # already running, there use `await comtrade.download_all(...)` instead.
+    return asyncio.run(download_all(reporters, periods, out_dir, **kwargs))
+
+
+def get_shard_paths(out_dir):
+    # Only partitions recorded in the manifest are complete, anything else in
+    # the folder (half written .part files, earlier merges) is ignored
+    manifest = Manifest(out_dir)
+    paths = [partition_path(out_dir, p) for p in manifest.entries]
+    return [path for path in paths if os.path.exists(path)]
+
+
+def _key_hashes(df, key):
+    return pd.util.hash_pandas_object(df[key], index=False).to_numpy()
+
+
+def _partition_dir(dataset_dir, partition_cols, values):
+    # Directory pq.write_to_dataset uses for one combination of partition values
+    return os.path.join(dataset_dir, *[f"{col}={value}" for col, value in zip(partition_cols, values)])
+
+
+def _load_partition_keys(partition_dir, key):
+    # Sorted key hashes of the rows already in one partition, read one file
+    # at a time and only for the key columns
+    hashes = [np.empty(0, dtype=np.uint64)]
+    if os.path.isdir(partition_dir):
+        for name in sorted(os.listdir(partition_dir)):
+            if not name.endswith(".parquet"):
+                continue
+            path = os.path.join(partition_dir, name)
+            columns = [c for c in key if c in pq.read_schema(path).names]
+            keys = pq.read_table(path, columns=columns).to_pandas()
+            hashes.append(_key_hashes(keys, columns))
+    return np.unique(np.concatenate(hashes))
+
+
+def merge_shards(shard_paths, dataset_dir, chunksize=100000, key=schema.NATURAL_KEY,
+                 partition_cols=DATASET_PARTITION_COLUMNS):
+    # Streams every shard in chunks of `chunksize` rows into a Parquet dataset
+    # partitioned by `partition_cols`. Rows whose natural key has been seen
+    # before (in this run or already in the dataset) are dropped. The key
+    # determines the partition (Reporter Code and Period fix Reporter ISO and
+    # Year), so duplicates are only looked for within the partition a row
+    # goes to: memory holds one chunk plus the key hashes (8 bytes per row) of
+    # the partition being written, whatever the number of shards. Shards are
+    # taken in name order, reporter then period, so consecutive shards mostly
+    # land in the same partition and its keys are read from disk once.
+    os.makedirs(dataset_dir, exist_ok=True)
+    current, seen = None, None
+    written = 0
+    for path in sorted(shard_paths, key=os.path.basename):
+        reader = pd.read_csv(path, chunksize=chunksize, dtype=schema.STORAGE_DTYPES)
+        for chunk in reader:
+            chunk = chunk.loc[:, ~chunk.columns.str.startswith("Unnamed:")]
+            # Partition columns are not stored in the files, and constant
+            # within a partition anyway
+            columns = [c for c in key if c in chunk.columns and c not in partition_cols]
+            for values, part in chunk.groupby(list(partition_cols), sort=False):
+                values = values if isinstance(values, tuple) else (values,)
+                if values != current:
+                    current = values
+                    seen = _load_partition_keys(_partition_dir(dataset_dir, partition_cols, values), columns)
+                hashes = _key_hashes(part, columns)
+                pos = np.minimum(np.searchsorted(seen, hashes), max(len(seen) - 1, 0))
+                new = seen[pos] != hashes if len(seen) else np.ones(len(hashes), dtype=bool)
+                # Duplicates inside the chunk itself: keep the first occurrence
+                _, first = np.unique(hashes, return_index=True)
+                unique = np.zeros(len(hashes), dtype=bool)
+                unique[first] = True
+                keep = new & unique
+                if not keep.any():
+                    continue
+                seen = np.union1d(seen, hashes[keep])
+                table = pa.Table.from_pandas(part[keep], preserve_index=False)
+                pq.write_to_dataset(table, dataset_dir, partition_cols=list(partition_cols))
+                written += int(keep.sum())
+    return written
@@ -0,0 +1,103 @@
+import io
+import os
+import threading
+
+import pandas as pd
+import requests
+from cachecontrol import CacheControlAdapter
+from cachecontrol.caches.file_cache import FileCache
+from cachecontrol.heuristics import ExpiresAfter
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "dataset", ".http_cache")
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+_default_session = None
+_default_session_lock = threading.Lock()
+
+
+class LRUFileCache(FileCache):
+    # CacheControl's FileCache never deletes anything on its own. This one
+    # keeps the total size of the cached responses under `max_bytes` by
+    # dropping the least recently used entries; the mtime of an entry is
+    # bumped on every hit and used as its recency.
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, **kwargs):
+        super().__init__(directory, **kwargs)
+        self.max_bytes = max_bytes
+        self._evict_lock = threading.Lock()
+
+    def get(self, key):
+        value = super().get(key)
+        if value is not None:
+            try:
+                os.utime(self._fn(key))
+            except OSError:
+                pass
+        return value
+
+    def set(self, key, value, expires=None):
+        super().set(key, value)
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".lock"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        with self._evict_lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+
+
+def cached_session(session=None, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES,
+                   pool_size=10):
+    # Wraps a requests session with a disk cache keyed on the full URL, query
+    # string included. The Comtrade API sends no caching headers, so every
+    # response is treated as fresh for `ttl` seconds; once expired, a response
+    # carrying an ETag is revalidated with a conditional request instead of
+    # being downloaded again.
+    if session is None:
+        session = requests.Session()
+    cache = LRUFileCache(cache_dir, max_bytes=max_bytes)
+    adapter = CacheControlAdapter(cache=cache, heuristic=ExpiresAfter(seconds=ttl),
+                                  pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    # Process wide cached session for notebooks
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = cached_session()
+        return _default_session
+
+
+def read_csv(url, **kwargs):
+    # Drop-in replacement for pd.read_csv(url) that goes through the cache
+    response = get_session().get(url)
+    response.raise_for_status()
+    return pd.read_csv(io.BytesIO(response.content), **kwargs)
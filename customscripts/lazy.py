@@ -0,0 +1,36 @@
+import importlib
+import sys
+import threading
+
+_lock = threading.Lock()
+
+
+class LazyModule():
+    # Stand-in for a module that is only imported when one of its attributes
+    # is first used, so importing a file that needs tensorflow somewhere does
+    # not cost the tensorflow import until that code actually runs
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return getattr(load(self), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def load(module):
+    # The real module behind a LazyModule, imported on the first call
+    if module._module is None:
+        with _lock:
+            if module._module is None:
+                module._module = importlib.import_module(module._name)
+    return module._module
+
+
+def is_loaded(module):
+    return module._name in sys.modules
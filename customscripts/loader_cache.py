@@ -0,0 +1,190 @@
+import functools
+import hashlib
+import inspect
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "dataset", ".cache", "loaders")
+DEFAULT_MEMORY_BUDGET = 2 * 1024 ** 3
+# Part of every key: bump it to drop all cached frames, e.g. after a pandas
+# or pyarrow upgrade changes what the loaders return
+CACHE_VERSION = 1
+
+_memory = OrderedDict()
+_memory_bytes = 0
+_lock = threading.Lock()
+
+settings = {
+    "cache_dir": DEFAULT_CACHE_DIR,
+    "memory_budget": DEFAULT_MEMORY_BUDGET,
+    "disk": True,
+    # Deep copy on every hit, see cached
+    "copy": True,
+}
+
+
+def fingerprint(path):
+    # (path, mtime, size) of a file, or of every file below a directory
+    if os.path.isdir(path):
+        entries = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                entries.extend(fingerprint(os.path.join(root, name)))
+        return entries
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return [(path, None, None)]
+    return [(path, stat.st_mtime_ns, stat.st_size)]
+
+
+def _digest(value):
+    return hashlib.sha256(repr(value).encode()).hexdigest()[:32]
+
+
+def _freeze(df):
+    # Marks the arrays of a cached frame read-only, so writing through a
+    # shallow copy raises instead of changing what later callers get
+    for block in df._mgr.blocks:
+        values = block.values
+        values = getattr(values, "_codes", getattr(values, "_data", values))
+        if isinstance(values, np.ndarray):
+            values.flags.writeable = False
+    return df
+
+
+def _remember(key, df):
+    global _memory_bytes
+    nbytes = int(df.memory_usage(deep=True).sum())
+    if nbytes > settings["memory_budget"]:
+        return
+    if key in _memory:
+        _memory_bytes -= _memory.pop(key)[1]
+    _memory[key] = (_freeze(df), nbytes)
+    _memory_bytes += nbytes
+    while _memory_bytes > settings["memory_budget"]:
+        _, (_, evicted) = _memory.popitem(last=False)
+        _memory_bytes -= evicted
+
+
+def _recall(key):
+    entry = _memory.get(key)
+    if entry is None:
+        return None
+    _memory.move_to_end(key)
+    return entry[0]
+
+
+def _disk_path(call_key, source_key):
+    return os.path.join(settings["cache_dir"], f"{call_key}-{source_key}.parquet")
+
+
+def _load_from_disk(call_key, source_key):
+    path = _disk_path(call_key, source_key)
+    if not os.path.exists(path):
+        return None
+    try:
+        return pd.read_parquet(path)
+    except (OSError, pa.ArrowException):
+        return None
+
+
+def _store_on_disk(call_key, source_key, df):
+    cache_dir = settings["cache_dir"]
+    os.makedirs(cache_dir, exist_ok=True)
+    # Entries for older versions of the same source files are dead
+    for name in os.listdir(cache_dir):
+        if name.startswith(call_key + "-"):
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+    path = _disk_path(call_key, source_key)
+    tmp_path = path + ".tmp"
+    try:
+        df.to_parquet(tmp_path)
+    except (ValueError, TypeError, pa.ArrowException):
+        # Frames Parquet can't represent (mixed object columns...) are only
+        # cached in memory
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return
+    os.replace(tmp_path, path)
+
+
+def _code_key(loader, depends_on):
+    # Digest of the source of the loader's module (its helpers and constants
+    # included) and of the modules in depends_on, None if any is unavailable
+    try:
+        modules = [inspect.getmodule(loader)] + list(depends_on)
+        return _digest([CACHE_VERSION] + [inspect.getsource(module) for module in modules])
+    except (OSError, TypeError):
+        return None
+
+
+def cached(get_sources, depends_on=()):
+    # Decorator for the dataset loaders. `get_sources` takes the loader's
+    # arguments and returns the files/directories the loader reads. Results
+    # are kept in an in-process LRU bounded by settings["memory_budget"] bytes
+    # and persisted as Parquet, keyed on the loader arguments and the
+    # (path, mtime, size) of its sources, so editing a csv invalidates it.
+    # The key also covers the code of the loader's module and of the modules
+    # in `depends_on` (e.g. schema), so editing a loader, a helper or a dtype
+    # table invalidates what was cached with the old code.
+    # By default callers get a deep copy they may modify freely, which costs
+    # a full copy of the frame (memory and time) on every call. With
+    # copy=False (per call, or settings["copy"] for all of them) they get a
+    # shallow copy sharing the cached, read-only arrays instead: free, and
+    # any in-place write raises "assignment destination is read-only". That
+    # includes assigning to an existing column (pandas 1.x writes into the
+    # block); adding or dropping columns and non-inplace methods are fine.
+    def decorator(loader):
+        signature = inspect.signature(loader)
+        code_key = _code_key(loader, depends_on)
+
+        @functools.wraps(loader)
+        def wrapper(*args, copy=None, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            sources = get_sources(*bound.args, **bound.kwargs)
+            call_key = _digest((loader.__module__, loader.__qualname__, code_key, bound.args,
+                                sorted(bound.kwargs.items())))
+            source_key = _digest([fingerprint(source) for source in sources])
+            key = (call_key, source_key)
+            with _lock:
+                df = _recall(key)
+            if df is None and settings["disk"]:
+                df = _load_from_disk(call_key, source_key)
+                if df is not None:
+                    with _lock:
+                        _remember(key, df)
+            if df is None:
+                df = loader(*bound.args, **bound.kwargs)
+                with _lock:
+                    _remember(key, df)
+                if settings["disk"]:
+                    _store_on_disk(call_key, source_key, df)
+            if copy is None:
+                copy = settings["copy"]
+            return df.copy(deep=copy)
+
+        wrapper.uncached = loader
+        return wrapper
+    return decorator
+
+
+def clear(disk=False):
+    global _memory_bytes
+    with _lock:
+        _memory.clear()
+        _memory_bytes = 0
+    if disk and os.path.isdir(settings["cache_dir"]):
+        for name in os.listdir(settings["cache_dir"]):
+            if name.endswith(".parquet"):
+                os.remove(os.path.join(settings["cache_dir"], name))
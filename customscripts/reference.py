@@ -0,0 +1,128 @@
+import io
+import os
+import threading
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from customscripts import utils
+
+# Our Comtrade extracts use GER for Germany, the World Bank tables DEU
+COUNTRY_CODE_ALIASES = {
+    "DEU": "GER",
+}
+
+_tables = {}
+_frames = {}
+_lock = threading.Lock()
+
+
+def canonicalize(codes):
+    return np.array([COUNTRY_CODE_ALIASES.get(code, code) for code in codes], dtype=object)
+
+
+class ReferenceTable():
+    # Dense (country x year) array of one yearly indicator. `present` tells a
+    # missing key apart from a key whose value is NaN.
+    def __init__(self, countries, years, values, present=None):
+        self.countries = pd.Index(countries)
+        self.years = np.asarray(years, dtype="int64")
+        self.values = np.asarray(values, dtype=float)
+        self.present = np.ones(self.values.shape, dtype=bool) if present is None else present
+
+    @classmethod
+    def from_long(cls, df, country_col="Country Code", year_col="Year", value_col="Value"):
+        # One row per (country, year); when a key repeats the last row wins
+        countries = canonicalize(df[country_col].astype(str))
+        years = df[year_col].to_numpy(dtype="int64")
+        country_index = pd.Index(pd.unique(countries))
+        year_index = np.unique(years)
+        values = np.full((len(country_index), len(year_index)), np.nan)
+        present = np.zeros(values.shape, dtype=bool)
+        rows = country_index.get_indexer(countries)
+        cols = np.searchsorted(year_index, years)
+        # Keep only the last occurrence of every (country, year)
+        flat = rows * len(year_index) + cols
+        _, last = np.unique(flat[::-1], return_index=True)
+        last = len(flat) - 1 - last
+        values[rows[last], cols[last]] = df[value_col].to_numpy(dtype=float)[last]
+        present[rows[last], cols[last]] = True
+        return cls(country_index, year_index, values, present)
+
+    @classmethod
+    def from_wide(cls, df, country_col="Country Code", years=None):
+        # One row per country, one column per year ("1960", "1961"...)
+        if years is None:
+            years = sorted(int(col) for col in df.columns if str(col).isdigit())
+        long_data = df.melt(id_vars=[country_col], value_vars=[str(year) for year in years],
+                            var_name="Year", value_name="Value")
+        long_data["Year"] = long_data["Year"].astype(int)
+        return cls.from_long(long_data, country_col, "Year", "Value")
+
+    def restrict(self, years):
+        # Same table with only the given years
+        keep = np.isin(self.years, np.asarray(list(years), dtype="int64"))
+        return ReferenceTable(self.countries, self.years[keep], self.values[:, keep], self.present[:, keep])
+
+    def lookup(self, countries, years):
+        # Vectorized gather for one (country, year) pair per row. Returns the
+        # values (NaN where there is none) and the mask of rows with a key.
+        # Resolve every distinct country once, rows gather through the codes
+        codes, uniques = pd.factorize(np.asarray(countries, dtype=object))
+        unique_rows = self.countries.get_indexer(canonicalize(uniques))
+        rows = np.where(codes >= 0, unique_rows[codes], -1) if len(uniques) else np.full(len(codes), -1)
+        years = np.asarray(years, dtype=float)
+        cols = np.searchsorted(self.years, np.nan_to_num(years, nan=-1))
+        cols = np.minimum(cols, len(self.years) - 1)
+        matched = (rows >= 0) & ~np.isnan(years) & (len(self.years) > 0)
+        if len(self.years):
+            matched &= self.years[cols] == years
+        result = np.full(len(rows), np.nan)
+        result[matched] = self.values[rows[matched], cols[matched]]
+        matched[matched] = self.present[rows[matched], cols[matched]]
+        return result, matched
+
+
+def _read_week4(name):
+    # dataset/week4/<name>.csv, or the copy inside dataset/week4.zip
+    csv_path = f"{utils.get_dataset_dir()}/week4/{name}.csv"
+    zip_path = f"{utils.get_dataset_dir()}/week4.zip"
+    if not os.path.exists(csv_path) and os.path.exists(zip_path):
+        with zipfile.ZipFile(zip_path) as archive:
+            return pd.read_csv(io.BytesIO(archive.read(f"week4/{name}.csv")))
+    return utils.get_dataset_df(4, name)
+
+
+def _load(name):
+    frame = _read_week4(name)
+    frame["Country Code"] = canonicalize(frame["Country Code"])
+    if name == "population":
+        table = ReferenceTable.from_wide(frame)
+    else:
+        table = ReferenceTable.from_long(frame)
+    return frame, table
+
+
+def _get(name):
+    with _lock:
+        if name not in _tables:
+            _frames[name], _tables[name] = _load(name)
+        return _frames[name], _tables[name]
+
+
+def get_table(name):
+    # Process wide dense table of "gdp" or "population", loaded once
+    return _get(name)[1]
+
+
+def get_frame(name):
+    # The table as read from disk with canonical country codes. A copy, so
+    # callers can filter or modify it freely.
+    return _get(name)[0].copy()
+
+
+def clear():
+    with _lock:
+        _tables.clear()
+        _frames.clear()
@@ -0,0 +1,132 @@
+# Column registry for the Comtrade csv exports (legacy API, fmt=csv)
+import pandas as pd
+
+
+# Wide dtypes used when storing shards: stable across chunks, so every
+# Parquet file of a dataset ends up with the same schema
+STORAGE_DTYPES = {
+    "Classification": str,
+    "Year": "int64",
+    "Period": "int64",
+    "Period Desc.": str,
+    "Aggregate Level": "float64",
+    "Is Leaf Code": "float64",
+    "Trade Flow Code": "float64",
+    "Trade Flow": str,
+    "Reporter Code": "float64",
+    "Reporter": str,
+    "Reporter ISO": str,
+    "Partner Code": "float64",
+    "Partner": str,
+    "Partner ISO": str,
+    "2nd Partner Code": "float64",
+    "2nd Partner": str,
+    "2nd Partner ISO": str,
+    "Customs Proc. Code": str,
+    "Customs": str,
+    "Mode of Transport Code": "float64",
+    "Mode of Transport": str,
+    "Commodity Code": str,
+    "Commodity": str,
+    "Qty Unit Code": "float64",
+    "Qty Unit": str,
+    "Qty": "float64",
+    "Alt Qty Unit Code": "float64",
+    "Alt Qty Unit": str,
+    "Alt Qty": "float64",
+    "Netweight (kg)": "float64",
+    "Gross weight (kg)": "float64",
+    "Trade Value (US$)": "float64",
+    "CIF Trade Value (US$)": "float64",
+    "FOB Trade Value (US$)": "float64",
+    "Flag": "float64",
+}
+
+# Compact dtypes used by the loaders. Labels with few distinct values become
+# categoricals, codes get the smallest int that fits. The ints are read as
+# nullable so a missing value doesn't make read_csv raise, to_numpy_dtypes
+# turns them back into numpy dtypes afterwards. Trade values, quantities and
+# weights stay float64: they go up to 1e12 and float32 only keeps ~7
+# significant digits.
+COMPACT_DTYPES = {
+    "Classification": "category",
+    "Year": "Int16",
+    "Period": "Int32",
+    "Period Desc.": str,
+    "Aggregate Level": "Int8",
+    "Is Leaf Code": "Int8",
+    "Trade Flow Code": "Int8",
+    "Trade Flow": "category",
+    "Reporter Code": "Int16",
+    "Reporter": "category",
+    "Reporter ISO": "category",
+    "Partner Code": "Int16",
+    "Partner": "category",
+    "Partner ISO": "category",
+    "Commodity Code": "Int32",
+    "Commodity": "category",
+    "Qty Unit Code": "float32",
+    "Qty Unit": "category",
+    "Qty": "float64",
+    "Netweight (kg)": "float64",
+    "Trade Value (US$)": "float64",
+    "Flag": "Int8",
+}
+
+# Placeholders of the legacy API that are empty in the extracts we pull,
+# the cleaning loaders would drop them with dropna(axis=1, how="all") anyway
+# and pass them in `drop`
+EMPTY_COLUMNS = [
+    "2nd Partner Code",
+    "2nd Partner",
+    "2nd Partner ISO",
+    "Customs Proc. Code",
+    "Customs",
+    "Mode of Transport Code",
+    "Mode of Transport",
+    "Alt Qty Unit Code",
+    "Alt Qty Unit",
+    "Alt Qty",
+    "Gross weight (kg)",
+    "CIF Trade Value (US$)",
+    "FOB Trade Value (US$)",
+]
+
+# Natural key of a Comtrade record. Reporter ISO and Year are left out
+# since they are implied by Reporter Code and Period.
+NATURAL_KEY = [
+    "Classification",
+    "Period",
+    "Trade Flow Code",
+    "Reporter Code",
+    "Partner Code",
+    "2nd Partner Code",
+    "Customs Proc. Code",
+    "Mode of Transport Code",
+    "Commodity Code",
+]
+
+
+def get_read_options(drop=(), compact=True):
+    # Keyword arguments for pd.read_csv: the dropped columns are skipped by
+    # the parser, the rest get their registered dtype. usecols is a callable
+    # so files missing some of the columns still load.
+    skipped = set(drop)
+    dtypes = COMPACT_DTYPES if compact else STORAGE_DTYPES
+    return {
+        "usecols": lambda col: col not in skipped,
+        "dtype": {col: dtype for col, dtype in dtypes.items() if col not in skipped},
+    }
+
+
+def to_numpy_dtypes(df):
+    # Nullable int columns become the numpy int of the same size, or float64
+    # when they hold missing values, which is what read_csv gives by default
+    for col in df.columns:
+        dtype = df[col].dtype
+        if isinstance(dtype, pd.api.extensions.ExtensionDtype) and pd.api.types.is_integer_dtype(dtype):
+            if df[col].isna().any():
+                df[col] = df[col].astype("float64")
+            else:
+                df[col] = df[col].astype(dtype.numpy_dtype)
+    return df
@@ -1,8 +1,16 @@
 import os
+import warnings
+from types import MappingProxyType
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 import pycountry
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from customscripts import schema
+from customscripts import loader_cache
 
 def get_dataset_dir():
     return f"{os.path.dirname(os.path.dirname(__file__))}/dataset"
@@ -10,8 +18,9 @@ def get_dataset_dir():
 def get_raw_dataset_path():
     return f"{get_dataset_dir()}/comtrade.csv"
 
-def get_raw_dataset_df():
-    return pd.read_csv(get_raw_dataset_path())
+@loader_cache.cached(lambda drop: [get_raw_dataset_path()], depends_on=(schema,))
+def get_raw_dataset_df(drop=()):
+    return schema.to_numpy_dtypes(pd.read_csv(get_raw_dataset_path(), **schema.get_read_options(drop)))
 
 def get_race_dataset_path():
     return f"{get_dataset_dir()}/race_ALL.csv"
@@ -19,19 +28,21 @@ def get_race_dataset_path():
 def get_raw_food_dataset_path():
     return f"{get_dataset_dir()}/food_data.csv"
 
+@loader_cache.cached(lambda: [get_raw_food_dataset_path()])
 def get_raw_food_dataset_df():
     return pd.read_csv(get_raw_food_dataset_path())
 
+CLEAN_COMTRADE_DROPPED_COLUMNS = ["Netweight (kg)", "Period", "Classification", "Trade Flow Code", "Reporter Code", "Commodity Code", "Commodity", "Partner"]
+
 def get_clean_comtrade():
-    raw_data = get_raw_dataset_df()
+    # The explicitly dropped and the always empty columns are never parsed.
+    # Only non-inplace operations follow, no need for a private copy.
+    raw_data = get_raw_dataset_df(drop=CLEAN_COMTRADE_DROPPED_COLUMNS + schema.EMPTY_COLUMNS, copy=False)
     data_no_junk = raw_data.dropna(axis=1, how="all")
     data_no_zeros = data_no_junk.loc[:, (data_no_junk != 0).any(axis=0)]
-    data_drop_netweight = data_no_zeros.drop(columns=["Netweight (kg)"])
-    data_drop_period = data_drop_netweight.drop(columns=["Period"])
-    data_drop_period_year = data_drop_period.replace({"Period Desc.": r"\s\d{4}$"}, {"Period Desc.": ""}, regex=True)
+    data_drop_period_year = data_no_zeros.replace({"Period Desc.": r"\s\d{4}$"}, {"Period Desc.": ""}, regex=True)
     data_rename_period_desc = data_drop_period_year.rename(columns={"Period Desc.": "Month"})
-    data_no_duplicate_columns = data_rename_period_desc.drop(columns=["Classification", "Trade Flow Code", "Reporter Code", "Commodity Code", "Commodity", "Partner"])
-    return data_no_duplicate_columns
+    return data_rename_period_desc
 
 def get_clean_food_dataset():
     data = get_raw_food_dataset_df()
@@ -41,45 +52,177 @@ def get_clean_food_dataset():
     data = data.rename(columns={"Year": "Date"})
     return data
 
+RACE_DROPPED_COLUMNS = [
+    "Unnamed: 0",
+    "Trade Flow Code",
+    "Reporter Code",
+    "Partner",
+    "Year",
+    "Period Desc."
+]
+
+@loader_cache.cached(lambda: [get_race_dataset_path()], depends_on=(schema,))
 def get_race_dataset_df():
-    raw_data = pd.read_csv(get_race_dataset_path())
+    raw_data = pd.read_csv(get_race_dataset_path(), **schema.get_read_options(RACE_DROPPED_COLUMNS + schema.EMPTY_COLUMNS))
+    raw_data = schema.to_numpy_dtypes(raw_data)
     raw_data["Period"] = pd.to_datetime(raw_data["Period"], format="%Y%m")
-    columns_to_drop = [
-        "Unnamed: 0",
-        "Trade Flow Code",
-        "Reporter Code",
-        "Partner",
-        "Year",
-        "Period Desc."
-    ]
-    drop_columns = raw_data.drop(columns=columns_to_drop)
-    data_no_junk = drop_columns.dropna(axis=1, how="all")
+    data_no_junk = raw_data.dropna(axis=1, how="all")
     data_no_zeros = data_no_junk.loc[:, (data_no_junk != 0).any(axis=0)]
     data_period_index = data_no_zeros.set_index("Period")
     return data_period_index
 
+def get_race_dataset_2010123_path():
+    return f"{get_dataset_dir()}/2010_123.csv"
+
+@loader_cache.cached(lambda: [get_race_dataset_2010123_path()])
 def get_race_dataset_2010123_df():
-    return pd.read_csv(f"{get_dataset_dir()}/2010_123.csv")
+    return pd.read_csv(get_race_dataset_2010123_path())
 
 ## / End Week 1, 2
 
 ## Week3
 
-def get_dataset_df(weekNumber, fileName):
-    return pd.read_csv(f"{get_dataset_dir()}/week{weekNumber}/{fileName}.csv")
+DEFAULT_PARTITION_COLUMNS = ["Reporter ISO", "Year"]
+
+_FILTER_OPS = {
+    "=": lambda col, val: col == val,
+    "==": lambda col, val: col == val,
+    "!=": lambda col, val: col != val,
+    "<": lambda col, val: col < val,
+    "<=": lambda col, val: col <= val,
+    ">": lambda col, val: col > val,
+    ">=": lambda col, val: col >= val,
+    "in": lambda col, val: col.isin(val),
+    "not in": lambda col, val: ~col.isin(val),
+}
+
+def get_partitioned_dataset_path(weekNumber, fileName):
+    return f"{get_dataset_dir()}/week{weekNumber}/{fileName}"
+
+def get_dataset_sources(weekNumber, fileName, filters=None):
+    dataset_path = get_partitioned_dataset_path(weekNumber, fileName)
+    return [dataset_path, f"{dataset_path}.csv"]
+
+# filters use the pyarrow syntax: a list of (column, op, value) tuples that
+# are ANDed, e.g. [("Reporter ISO", "in", ["USA", "CHN"]), ("Year", ">=", 2015)],
+# or a list of such lists that are ORed together
+@loader_cache.cached(get_dataset_sources)
+def get_dataset_df(weekNumber, fileName, filters=None):
+    dataset_path = get_partitioned_dataset_path(weekNumber, fileName)
+    if os.path.isdir(dataset_path):
+        # Only the partition directories matching the filters are opened
+        table = pq.read_table(dataset_path, filters=filters)
+        return _restore_partition_dtypes(table.to_pandas(), dataset_path)
+    df = pd.read_csv(f"{dataset_path}.csv")
+    return apply_filters(df, filters)
+
+def iter_dataset_chunks(weekNumber, fileName, chunksize):
+    # Same data as get_dataset_df, as a stream of frames of at most chunksize rows
+    dataset_path = get_partitioned_dataset_path(weekNumber, fileName)
+    if os.path.isdir(dataset_path):
+        dataset = ds.dataset(dataset_path, format="parquet", partitioning="hive")
+        for batch in dataset.to_batches(batch_size=chunksize):
+            yield _restore_partition_dtypes(batch.to_pandas(), dataset_path)
+        return
+    for chunk in pd.read_csv(f"{dataset_path}.csv", chunksize=chunksize):
+        yield chunk
+
+COMMON_METADATA_NAME = "_common_metadata"
+
+def _read_common_schema(dataset_path):
+    path = os.path.join(dataset_path, COMMON_METADATA_NAME)
+    if not os.path.exists(path):
+        return None
+    return pq.read_schema(path)
+
+def _partition_columns(dataset_path):
+    # Names of the col=value directory levels of a hive partitioned dataset
+    columns = []
+    path = dataset_path
+    while True:
+        subdirs = sorted(name for name in os.listdir(path) if "=" in name and os.path.isdir(os.path.join(path, name)))
+        if not subdirs:
+            return columns
+        columns.append(subdirs[0].split("=", 1)[0])
+        path = os.path.join(path, subdirs[0])
+
+def _restore_partition_dtypes(df, dataset_path):
+    # Partition keys come back last, as categoricals or int32. The
+    # _common_metadata written by write_partitioned_dataset has the schema of
+    # the frame that was written: columns get its order and dtypes back, so
+    # the result matches what read_csv gives for the same data. Without it the
+    # keys get read_csv's defaults (int64, float64, object) and stay last.
+    schema = _read_common_schema(dataset_path)
+    # An empty frame of the schema has the written pandas dtypes, including
+    # categoricals, nullable ints and tz-aware timestamps
+    targets = {} if schema is None else dict(schema.empty_table().to_pandas().dtypes)
+    partition_cols = _partition_columns(dataset_path)
+    for col in df.columns:
+        dtype = df[col].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(df[col].cat.categories.dtype)
+            dtype = df[col].dtype
+        target = targets.get(col)
+        if isinstance(target, pd.CategoricalDtype):
+            # categories are rebuilt from the values that were read
+            values = df[col] if dtype == target.categories.dtype else df[col].astype(target.categories.dtype)
+            df[col] = values.astype(pd.CategoricalDtype(ordered=target.ordered))
+            continue
+        if target is None:
+            if col not in partition_cols:
+                continue
+            if pd.api.types.is_integer_dtype(dtype):
+                target = np.dtype("int64")
+            elif pd.api.types.is_float_dtype(dtype):
+                target = np.dtype("float64")
+            else:
+                continue
+        if dtype != target:
+            df[col] = df[col].astype(target)
+    if schema is not None:
+        order = [col for col in schema.names if col in df.columns]
+        df = df[order + [col for col in df.columns if col not in targets]]
+    return df
+
+def apply_filters(df, filters):
+    if not filters:
+        return df
+    if not isinstance(filters[0], list):
+        filters = [filters]
+    mask = np.zeros(len(df), dtype=bool)
+    for conjunction in filters:
+        conj_mask = np.ones(len(df), dtype=bool)
+        for col, op, val in conjunction:
+            conj_mask &= _FILTER_OPS[op](df[col], val).to_numpy()
+        mask |= conj_mask
+    return df[mask].reset_index(drop=True)
+
+def write_partitioned_dataset(df, weekNumber, fileName, partition_cols=DEFAULT_PARTITION_COLUMNS):
+    # Writes df in the dataset/week{N}/{fileName}/col=value/... layout that
+    # get_dataset_df prefers over the csv file
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    dataset_path = get_partitioned_dataset_path(weekNumber, fileName)
+    pq.write_to_dataset(table, dataset_path, partition_cols=partition_cols)
+    # The files lack the partition columns, keep the full schema next to them
+    pq.write_metadata(table.schema, os.path.join(dataset_path, COMMON_METADATA_NAME))
 
 def merge_income_index_column(df, years):
-    df['Income_Index'] = 0.0
-    for i, val in enumerate(years):
-        col = 'ii' + str(val)
-        if(i == 0):
-            df['Income_Index'] = np.where((df['Year'] <=val), df[col], df['Income_Index'])
-        elif (i == (len(years) - 1)):
-            prev = years[i-1]
-            df['Income_Index'] = np.where((df['Year'] > prev), df[col], df['Income_Index'])
-        else:
-            prev = years[i-1]
-            df['Income_Index'] = np.where((df['Year'] > prev) & (df['Year'] <= val), df[col], df['Income_Index'])
+    # years are the ascending breakpoints of the ii<year> columns: a row gets
+    # ii<years[i]> when years[i-1] < Year <= years[i], the first column for
+    # anything up to years[0] and the last one for anything after years[-2]
+    year = df['Year'].to_numpy(dtype=float)
+    breakpoints = np.asarray(years, dtype=float)
+    values = df[['ii' + str(val) for val in years]].to_numpy(dtype=float)
+    idx = np.searchsorted(breakpoints, year, side='left')
+    idx = np.minimum(idx, len(years) - 1)
+    result = values[np.arange(len(df)), idx]
+    # Rows no bucket applies to keep 0.0: missing years, and with a single
+    # breakpoint the years after it
+    unmatched = np.isnan(year)
+    if len(years) == 1:
+        unmatched |= year > breakpoints[0]
+    result[unmatched] = 0.0
+    df['Income_Index'] = result
     return df
 
 ## End Week3
@@ -98,64 +241,109 @@ def human_format(num, pos=None):
 def get_2020_months():
     return ["January", "February", "March", "April", "May", "June", "July", "August", "September"]
 
-def abbreviate_countries(df, col_name):
-    #populate country abbreviation dictionary for replacement
-    countries = {}
-    for country in pycountry.countries:
-        countries[country.name] = country.alpha_3
-    countries['China, Hong Kong SAR'] = 'HKG'
-    countries['China (Hong Kong SAR)'] = 'HKG'
-    countries['Hong Kong, China (SAR)'] = 'HKG'
-    countries['China, Macao SAR'] = 'MAC'
-    countries['Macao, China (SAR)'] = 'MAC'
-    countries['Rep. of Korea'] = 'KOR'
-    countries['Republic of Korea'] = 'KOR'
-    countries['Korea (Republic of)'] = 'KOR'
-    countries['Korea (Rep. of)'] = 'KOR'
+# Names used by the different sources (Comtrade, World Bank, UNICEF...) that
+# differ from the pycountry names
+COUNTRY_ALIASES = {
+    'China, Hong Kong SAR': 'HKG',
+    'China (Hong Kong SAR)': 'HKG',
+    'Hong Kong, China (SAR)': 'HKG',
+    'China, Macao SAR': 'MAC',
+    'Macao, China (SAR)': 'MAC',
+    'Rep. of Korea': 'KOR',
+    'Republic of Korea': 'KOR',
+    'Korea (Republic of)': 'KOR',
+    'Korea (Rep. of)': 'KOR',
     # NB: this is North Korea
-    countries['Democratic People\'s Republic of Korea'] = 'PRK'
-    countries['Korea, Dem. P.R. of'] = 'PRK'
-    countries['Congo (Democratic Republic of the)'] = 'COD'
-    countries['Congo, Democratic Republic'] = 'COD'
-    countries['Democratic Republic of the Congo'] = 'COD'
-    countries['DR Congo'] = 'COD'
-    countries['Vietnam'] = 'VNM'
-    countries['Bolivia (Plurinational State of)'] = 'BOL'
-    countries['United Republic of Tanzania'] = 'TZA'
-    countries['Iran (Islamic Republic of)'] = 'IRN'
-    countries['Iran'] = 'IRN'
-    countries['State of Palestine'] = 'PSE'
-    countries['Republic of Moldova'] = 'MDA'
-    countries['Venezuela (Bolivarian Republic of)'] = 'VEN'
-    countries['Bolivia'] = 'BOL'
-    countries["Cote d'Ivoire"] = 'CIV'
-    countries['Czech Republic'] = 'CZE'
-    countries['Guinea Bissau'] = 'GNB'
-    countries['Lao PDR'] = 'LAO'
-    countries['Macedonia (TFYR)'] = 'MKD'
-    countries['Micronesia (Federated States of)'] = 'FSM'
-    countries['Moldova'] = 'MDA'
-    countries['North Korea'] = 'PRK'
-    countries['Occupied Palestinian Territory'] = '000'
-    countries['South Korea'] = 'KOR'
-    countries['Swaziland'] = 'SWZ'
-    countries['Taiwan'] = 'TWN'
-    countries['Tanzania'] = 'TZA'
-    countries['United States of America'] = 'USA'
-    countries['Venezuela'] = 'VEN'
-    countries['Ireland, Republic of'] = 'IRL'
-    countries['Bosnia & Herzegovina'] = 'BIH'
-    countries['Eswatini (Swaziland)'] = 'SWZ'
-    countries['Brunei'] = 'BRN'
-    countries['Trinidad & Tobago'] = 'TTO'
-    countries['Yemen, Republic of'] = 'YEM'
-    countries['Russia'] = 'RUS'
-    countries['Ivory Coast'] = 'CIV'
-    countries['Syria'] = 'SYR'
-    countries['Laos'] = 'LAO'
-    countries['East Timor'] = 'TLS'
-
-    #specify concatenate countries dictionary to needed columns
-    con_map = {col_name: countries}
-    df.replace(con_map, inplace=True)
+    'Democratic People\'s Republic of Korea': 'PRK',
+    'Korea, Dem. P.R. of': 'PRK',
+    'Congo (Democratic Republic of the)': 'COD',
+    'Congo, Democratic Republic': 'COD',
+    'Democratic Republic of the Congo': 'COD',
+    'DR Congo': 'COD',
+    'Vietnam': 'VNM',
+    'Bolivia (Plurinational State of)': 'BOL',
+    'United Republic of Tanzania': 'TZA',
+    'Iran (Islamic Republic of)': 'IRN',
+    'Iran': 'IRN',
+    'State of Palestine': 'PSE',
+    'Republic of Moldova': 'MDA',
+    'Venezuela (Bolivarian Republic of)': 'VEN',
+    'Bolivia': 'BOL',
+    "Cote d'Ivoire": 'CIV',
+    'Czech Republic': 'CZE',
+    'Guinea Bissau': 'GNB',
+    'Lao PDR': 'LAO',
+    'Macedonia (TFYR)': 'MKD',
+    'Micronesia (Federated States of)': 'FSM',
+    'Moldova': 'MDA',
+    'North Korea': 'PRK',
+    'Occupied Palestinian Territory': '000',
+    'South Korea': 'KOR',
+    'Swaziland': 'SWZ',
+    'Taiwan': 'TWN',
+    'Tanzania': 'TZA',
+    'United States of America': 'USA',
+    'Venezuela': 'VEN',
+    'Ireland, Republic of': 'IRL',
+    'Bosnia & Herzegovina': 'BIH',
+    'Eswatini (Swaziland)': 'SWZ',
+    'Brunei': 'BRN',
+    'Trinidad & Tobago': 'TTO',
+    'Yemen, Republic of': 'YEM',
+    'Russia': 'RUS',
+    'Ivory Coast': 'CIV',
+    'Syria': 'SYR',
+    'Laos': 'LAO',
+    'East Timor': 'TLS',
+}
+
+_country_index = None
+_country_codes = None
+
+def get_country_index():
+    # Built once on first use, read-only afterwards
+    global _country_index, _country_codes
+    if _country_index is None:
+        countries = {}
+        for country in pycountry.countries:
+            countries[country.name] = country.alpha_3
+        countries.update(COUNTRY_ALIASES)
+        _country_codes = frozenset(countries.values())
+        _country_index = MappingProxyType(countries)
+    return _country_index
+
+def abbreviate_countries(df, col_name, errors="warn"):
+    # Maps every distinct name once and gathers the result through the codes,
+    # so the cost depends on the number of countries, not of rows.
+    # Names that are neither known nor already a code are reported according
+    # to errors ("warn", "raise" or "ignore") and kept as they are.
+    index = get_country_index()
+    col = df[col_name]
+    is_categorical = isinstance(col.dtype, pd.CategoricalDtype)
+    if not is_categorical and pd.api.types.is_numeric_dtype(col.dtype):
+        return df
+    if is_categorical:
+        codes = col.cat.codes.to_numpy()
+        uniques = col.cat.categories
+    else:
+        codes, uniques = pd.factorize(col)
+    mapped = np.array([index.get(name, name) for name in uniques], dtype=object)
+
+    unmapped = sorted(str(name) for name in uniques if name not in index and name not in _country_codes)
+    if unmapped and errors != "ignore":
+        message = f"{len(unmapped)} unknown country names in '{col_name}': {unmapped}"
+        if errors == "raise":
+            raise ValueError(message)
+        warnings.warn(message)
+
+    if is_categorical:
+        categories = pd.Index(mapped).unique()
+        remap = categories.get_indexer(mapped)
+        new_codes = np.where(codes >= 0, remap[codes], -1)
+        df[col_name] = pd.Categorical.from_codes(new_codes, categories)
+    else:
+        values = mapped[codes]
+        missing = codes < 0
+        values[missing] = col.to_numpy()[missing]
+        df[col_name] = values
     return df
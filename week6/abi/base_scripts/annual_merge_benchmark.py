@@ -0,0 +1,74 @@
+# Regression check and benchmark for DataWrangling.merge_annual_data_columnwise.
+# Runs the keyed join against the original iterrows/np.where loop on
+# synthetic monthly trade rows and a long (Year, Country Code, Value) table
+# with repeated keys, NaN values and reporters without data. Fails if the
+# results differ in any column or dtype, or if the join is not faster.
+# Country codes with an alias in reference.COUNTRY_CODE_ALIASES (DEU) are left
+# out: the loop never matched them, the join maps them to our codes on purpose.
+# Run from the repository root: python week6/abi/base_scripts/annual_merge_benchmark.py
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+N_ROWS = 200000
+N_REPORTERS = 30
+YEARS = list(range(2010, 2021))
+MIN_SPEEDUP = 2.0
+
+
+def merge_annual_data_columnwise_loop(df, data, years, new_col_name):
+    # The implementation merge_annual_data_columnwise replaced
+    df[new_col_name] = 0.0
+    for index, row in data.iterrows():
+        val = int(row['Year'])
+        country = str(row['Country Code'])
+        df[new_col_name] = np.where((df['Time'].dt.year == val) & (df['Reporter'] == country), row['Value'], df[new_col_name])
+    return df
+
+
+def make_data(seed=0):
+    rng = np.random.default_rng(seed)
+    reporters = [f"R{i:02d}" for i in range(N_REPORTERS)]
+    months = pd.date_range(f"{YEARS[0]}-01-01", f"{YEARS[-1]}-12-01", freq="MS")
+    df = pd.DataFrame({
+        'Time': months[rng.integers(0, len(months), N_ROWS)],
+        # a few reporters the annual table knows nothing about
+        'Reporter': rng.choice(reporters + ["XXX", "YYY"], N_ROWS),
+        'Trade Value (US$)': rng.random(N_ROWS) * 1e9,
+    })
+    data = pd.DataFrame([(code, year) for code in reporters[:-3] for year in YEARS if year < YEARS[-1]],
+                        columns=['Country Code', 'Year'])
+    data['Value'] = rng.random(len(data)) * 1e12
+    data.loc[rng.choice(len(data), 10, replace=False), 'Value'] = np.nan
+    # repeated keys, the last row wins
+    data = pd.concat([data, data.sample(20, random_state=seed).assign(Value=-1.0)], ignore_index=True)
+    return df, data
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    sys.path.insert(0, ROOT)
+    from week6.abi.solution_scripts.data_wrangling import DataWrangling
+    # merge_annual_data_columnwise doesn't touch the loaded datasets
+    wrangling = DataWrangling.__new__(DataWrangling)
+    df, data = make_data()
+    expected, loop_seconds = timed(merge_annual_data_columnwise_loop, df.copy(), data, YEARS, 'GDP')
+    result, join_seconds = timed(wrangling.merge_annual_data_columnwise, df.copy(), data, YEARS, 'GDP')
+    print(f"{len(df)} rows, {len(data)} annual rows")
+    print(f"loop {loop_seconds:.3f}s, join {join_seconds:.3f}s, {loop_seconds / join_seconds:.1f}x")
+    pd.testing.assert_frame_equal(result, expected, check_exact=True)
+    assert loop_seconds / join_seconds >= MIN_SPEEDUP, f"join is only {loop_seconds / join_seconds:.1f}x faster"
+
+
+if __name__ == "__main__":
+    main()
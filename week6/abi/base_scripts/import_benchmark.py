@@ -0,0 +1,93 @@
+# Startup cost of solution_scripts/Networks.py per model type. Each model type
+# is measured in a fresh interpreter: import Networks, then load the backends
+# the model uses (Networks.BACKENDS). Fails if importing Networks loads any
+# backend, if a model type pulls in the backend of another one, or if the
+# bare import or the first use of a model type gets slower or bigger than the
+# limits below. Model types whose backend is not installed are reported as
+# skipped.
+# Run from the repository root: python week6/abi/base_scripts/import_benchmark.py
+import json
+import os
+import subprocess
+import sys
+
+MAX_IMPORT_SECONDS = 2.0
+MAX_IMPORT_RSS_MB = 400
+# First use of each model type: import Networks plus load its backends.
+# tensorflow dominates for LSTM and ANN.
+MAX_USE_SECONDS = {"LSTM": 15.0, "Facebook": 10.0, "ANN": 15.0, "VAR": 5.0}
+MAX_USE_RSS_MB = {"LSTM": 1500, "Facebook": 800, "ANN": 1500, "VAR": 500}
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+from week6.abi.solution_scripts import Networks
+from week6.abi.solution_scripts.memory_usage import peak_rss_bytes
+from customscripts import lazy
+imported = time.perf_counter()
+import_rss = peak_rss_bytes()
+on_import = sorted({m._name for ms in Networks.BACKENDS.values() for m in ms if lazy.is_loaded(m)})
+model = sys.argv[1]
+for module in Networks.BACKENDS[model]:
+    lazy.load(module)
+used = time.perf_counter()
+packages = {m._name.split('.')[0] for ms in Networks.BACKENDS.values() for m in ms}
+own = {m._name.split('.')[0] for m in Networks.BACKENDS[model]}
+print(json.dumps({
+    'import_seconds': imported - start,
+    'import_rss_mb': import_rss / 1024 ** 2,
+    'use_seconds': used - imported,
+    'use_rss_mb': peak_rss_bytes() / 1024 ** 2,
+    'loaded_on_import': on_import,
+    'foreign': sorted(p for p in packages - own if p in sys.modules),
+}))
+"""
+
+
+def measure(model):
+    # The probe's results, or the last line of its traceback if it failed
+    try:
+        output = subprocess.check_output([sys.executable, "-c", PROBE, model], cwd=ROOT,
+                                         stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        lines = e.stderr.decode().strip().splitlines()
+        return lines[-1] if lines else f"exit status {e.returncode}"
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    sys.path.insert(0, ROOT)
+    from week6.abi.solution_scripts import Networks
+    failures = []
+    print(f"{'model':<10}{'import s':>10}{'import MB':>11}{'first use s':>13}{'first use MB':>14}")
+    for model in Networks.BACKENDS:
+        result = measure(model)
+        if isinstance(result, str):
+            # a backend that is not installed only skips its model type
+            if result.startswith("ModuleNotFoundError"):
+                print(f"{model:<10}skipped: {result}")
+            else:
+                print(f"{model:<10}failed: {result}")
+                failures.append(f"{model}: {result}")
+            continue
+        print(f"{model:<10}{result['import_seconds']:>10.2f}{result['import_rss_mb']:>11.0f}"
+              f"{result['use_seconds']:>13.2f}{result['use_rss_mb']:>14.0f}")
+        if result["loaded_on_import"]:
+            failures.append(f"{model}: importing Networks loaded {result['loaded_on_import']}")
+        if result["foreign"]:
+            failures.append(f"{model}: first use also loaded {result['foreign']}")
+        if result["import_seconds"] > MAX_IMPORT_SECONDS:
+            failures.append(f"{model}: import took {result['import_seconds']:.2f}s")
+        if result["import_rss_mb"] > MAX_IMPORT_RSS_MB:
+            failures.append(f"{model}: import used {result['import_rss_mb']:.0f}MB")
+        if result["use_seconds"] > MAX_USE_SECONDS[model]:
+            failures.append(f"{model}: first use took {result['use_seconds']:.2f}s")
+        if result["use_rss_mb"] > MAX_USE_RSS_MB[model]:
+            failures.append(f"{model}: first use used {result['use_rss_mb']:.0f}MB")
+    assert not failures, "\n".join(failures)
+
+
+if __name__ == "__main__":
+    main()
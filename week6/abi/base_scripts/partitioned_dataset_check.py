@@ -0,0 +1,76 @@
+# Round trip of customscripts.utils.write_partitioned_dataset: a frame shaped
+# like the loader output (categorical Reporter ISO, Trade Flow and Reporter,
+# nullable and numpy ints, tz-aware timestamps) is written partitioned by
+# Reporter ISO and Year to a temporary dataset directory and read back with
+# get_dataset_df and iter_dataset_chunks. Fails unless both give the columns,
+# order and dtypes of the written frame (categories are rebuilt from the
+# values read, so only the ordered flag is compared for them).
+# Run from the repository root: python week6/abi/base_scripts/partitioned_dataset_check.py
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+N_ROWS = 1000
+
+
+def make_frame(seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "Year": rng.integers(2015, 2018, N_ROWS),
+        "Period": rng.integers(1, 13, N_ROWS) + 201500,
+        "Trade Flow": pd.Categorical(rng.choice(["Import", "Export"], N_ROWS)),
+        "Reporter": pd.Categorical(rng.choice(["Germany", "France", "Italy"], N_ROWS)),
+        "Reporter ISO": pd.Categorical(rng.choice(["DEU", "FRA", "ITA"], N_ROWS)),
+        "Flag": pd.array(rng.choice([0, 1, None], N_ROWS), dtype="Int8"),
+        "Time": pd.Timestamp("2015-01-01", tz="UTC") + pd.to_timedelta(rng.integers(0, 1000, N_ROWS), unit="D"),
+        "Trade Value (US$)": rng.random(N_ROWS) * 1e9,
+    })
+
+
+def normalize(df):
+    # row order depends on the partition layout
+    df = df.sort_values(["Reporter ISO", "Year", "Period", "Trade Value (US$)"]).reset_index(drop=True)
+    return df.astype({col: "object" for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)})
+
+
+def check_dtypes(name, result, expected):
+    assert list(result.columns) == list(expected.columns), f"{name}: columns {list(result.columns)}"
+    for col in expected.columns:
+        want, got = expected[col].dtype, result[col].dtype
+        if isinstance(want, pd.CategoricalDtype):
+            assert isinstance(got, pd.CategoricalDtype) and got.ordered == want.ordered, f"{name}: {col} is {got}"
+        else:
+            assert got == want, f"{name}: {col} is {got}, expected {want}"
+
+
+def check_values(name, result, expected):
+    pd.testing.assert_frame_equal(normalize(result), normalize(expected), check_dtype=False)
+    print(f"{name}: ok")
+
+
+def main():
+    sys.path.insert(0, ROOT)
+    from customscripts import loader_cache, utils
+    loader_cache.settings["disk"] = False
+    df = make_frame()
+    with tempfile.TemporaryDirectory() as tmp:
+        # the dataset goes to tmp/week0/check instead of the repo's dataset dir
+        utils.get_dataset_dir = lambda: tmp
+        utils.write_partitioned_dataset(df, 0, "check")
+        result = utils.get_dataset_df(0, "check")
+        check_dtypes("get_dataset_df", result, df)
+        check_values("get_dataset_df", result, df)
+        chunks = list(utils.iter_dataset_chunks(0, "check", 128))
+        for chunk in chunks:
+            check_dtypes("iter_dataset_chunks", chunk, df)
+        # chunks have their own categories, concat makes them plain values
+        check_values("iter_dataset_chunks", pd.concat(chunks, ignore_index=True), df)
+
+
+if __name__ == "__main__":
+    main()
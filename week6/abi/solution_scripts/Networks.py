@@ -1,53 +1,139 @@
 import datetime
+import os
 import numpy as np
 import pandas as pd
-import keras
 import locale
 import pickle
 import joblib
-from keras.models import Sequential
-from keras.callbacks import History 
-from keras import backend as K
-from keras.layers import Dense, LSTM, Flatten, Embedding
-from fbprophet import Prophet
-from tensorflow.keras.optimizers import Adam
-from sklearn.preprocessing import MinMaxScaler, RobustScaler, LabelBinarizer
-from sklearn.metrics import mean_absolute_error
-from statsmodels.tsa.stattools import adfuller
-from statsmodels.stats.stattools import durbin_watson
-from statsmodels.tsa.api import VAR as var
-import optuna
-import tensorflow as tf
-import tensorflow_addons as tfa
-from keras.utils.vis_utils import plot_model
+import warnings
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from customscripts.lazy import LazyModule
+
+# The model backends are imported when a model first uses them, so e.g. VAR
+# never loads tensorflow (see base_scripts/import_benchmark.py)
+keras = LazyModule('keras')
+K = LazyModule('keras.backend')
+vis_utils = LazyModule('keras.utils.vis_utils')
+tf = LazyModule('tensorflow')
+tfa = LazyModule('tensorflow_addons')
+optuna = LazyModule('optuna')
+fbprophet = LazyModule('fbprophet')
+preprocessing = LazyModule('sklearn.preprocessing')
+tsa_api = LazyModule('statsmodels.tsa.api')
+tsa_stattools = LazyModule('statsmodels.tsa.stattools')
+stats_stattools = LazyModule('statsmodels.stats.stattools')
+
+# What each model type loads on first use
+BACKENDS = {
+    'LSTM': (keras, K, tf, preprocessing),
+    'Facebook': (fbprophet,),
+    'ANN': (keras, K, vis_utils, tf, optuna, preprocessing),
+    'VAR': (tsa_api, tsa_stattools, stats_stattools),
+}
 
 def root_mean_squared_error(y_true, y_pred):
         return K.sqrt(K.mean(K.square(y_pred - y_true))) 
+
+def window_view(X, time_steps):
+    # Read-only (len(X) - time_steps + 1, time_steps, features) view on X,
+    # window i is X[i:i + time_steps]. No row is copied.
+    X = np.asarray(X)
+    if hasattr(np.lib.stride_tricks, 'sliding_window_view'):
+        view = np.lib.stride_tricks.sliding_window_view(X, time_steps, axis=0)
+        return np.moveaxis(view, -1, 1)
+    # numpy < 1.20
+    shape = (len(X) - time_steps + 1, time_steps) + X.shape[1:]
+    strides = (X.strides[0],) + X.strides
+    return np.lib.stride_tricks.as_strided(X, shape=shape, strides=strides, writeable=False)
+
+def window_layout(groups, n_rows, time_steps):
+    # Windows of time_steps rows plus a target row, each taken from the rows
+    # of a single group. Returns (order, starts): `order` lays the rows out
+    # group after group, keeping their order within a group (None without
+    # groups), and `starts` are the first rows of the windows in that layout.
+    # The window starting at s covers rows s..s + time_steps - 1 and its
+    # target is row s + time_steps. Windows are listed in the original order
+    # of their target rows, so for time-major data later windows still come
+    # last (e.g. for a validation split).
+    n = max(n_rows - time_steps, 0)
+    if groups is None:
+        return None, np.arange(n)
+    if isinstance(groups, pd.DataFrame):
+        codes = groups.groupby(list(groups.columns), sort=False).ngroup().to_numpy()
+    else:
+        codes = pd.factorize(np.asarray(groups))[0]
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+    # groups are contiguous now: first and target row in the same group
+    # means the whole window is
+    starts = np.flatnonzero(codes[time_steps:time_steps + n] == codes[:n])
+    starts = starts[np.argsort(order[starts + time_steps], kind='stable')]
+    return order, starts
+
+def sliding_windows(X, y, time_steps=1, groups=None):
+    # The pairs of the old create_dataset loop, X[i:i + time_steps] with
+    # y[i + time_steps], within each group. Returns (windows, targets,
+    # starts): windows[s] and targets[s] for s in starts. windows is a view,
+    # index it a batch of starts at a time to copy only that batch. With
+    # groups, X and y are first reordered group by group (one copy of the
+    # rows, see window_layout).
+    X = np.asarray(X)
+    y = np.asarray(y)
+    order, starts = window_layout(groups, len(X), time_steps)
+    if order is not None:
+        X, y = X[order], y[order]
+    if len(starts) == 0:
+        return np.empty((0, time_steps) + X.shape[1:], dtype=X.dtype), y[:0], starts
+    return window_view(X, time_steps)[:len(X) - time_steps], y[time_steps:], starts
+
 class LSTM():
 
-    def __init__(self, df, train, test, input_columns, output_column):
+    def __init__(self, df, train, test, input_columns, output_column, group_columns=None):
         self.input_columns = input_columns
         self.output_column = output_column
         self.train_var = train
         self.test_var = test
+        # Windows never span two groups of these columns (e.g. Reporter,
+        # Category Code)
+        self.group_columns = group_columns
 
         
 
-    def create_dataset(self, X, y, time_steps=1):
-        Xs, ys = [], []
-        for i in range(len(X) - time_steps):
-            v = X.iloc[i:(i + time_steps)].values
-            Xs.append(v)
-            ys.append(y.iloc[i + time_steps])
-        return np.array(Xs), np.array(ys)
+    def create_dataset(self, X, y, time_steps=1, groups=None):
+        # (X, y) arrays of every window and its target, a copy of each window.
+        # Training and test use get_windows, which copies a batch at a time.
+        windows, targets, starts = sliding_windows(X, y, time_steps, groups)
+        return windows[starts], targets[starts]
+
+    def get_windows(self, data, time_steps, batch_size, validation_split=None):
+        # keras Sequence of the windows of data, cut a batch at a time. With
+        # validation_split, the last part of the windows is returned as a
+        # second Sequence, like model.fit(validation_split=..., shuffle=False).
+        from week6.abi.solution_scripts import feeders
+        features = data.to_numpy(dtype=float)
+        targets = data[self.output_column].to_numpy(dtype=float)
+        order, starts = window_layout(self.get_groups(data), len(data), time_steps)
+        if order is not None:
+            features, targets = features[order], targets[order]
+        if validation_split is None:
+            return feeders.WindowSequence(features, targets, starts, time_steps, batch_size)
+        split = int(len(starts) * (1 - validation_split))
+        return (feeders.WindowSequence(features, targets, starts[:split], time_steps, batch_size),
+                feeders.WindowSequence(features, targets, starts[split:], time_steps, batch_size))
+
+    def get_groups(self, data):
+        if self.group_columns is None:
+            return None
+        return data[self.group_columns]
 
     def scale(self):
         train = self.train_var
         test = self.test_var
         #scale features
-        input_transformer = RobustScaler()
+        input_transformer = preprocessing.RobustScaler()
         #scale trade value
-        output_transformer = RobustScaler()
+        output_transformer = preprocessing.RobustScaler()
         input_transformer = input_transformer.fit(train[self.input_columns].to_numpy())
         output_transformer = output_transformer.fit(train[[self.output_column]])
         train.loc[:, self.input_columns] = input_transformer.transform(train[self.input_columns].to_numpy())
@@ -62,20 +148,74 @@ class LSTM():
             keras.callbacks.EarlyStopping(monitor='val_loss', patience=40),
             keras.callbacks.History()
         ]    
-    def train(self, hparams, filename):
-        X_train, y_train = self.create_dataset(self.train_var, self.train_var[self.output_column], hparams["time_steps"])
+    def get_sequences(self, time_steps, batch_size, store_dir, validation_split=0.2):
+        # Streaming counterpart of get_windows: the training frame goes to a
+        # memory-mapped store once, in window_layout order, and worker
+        # processes cut the windows from it batch by batch. train_var itself
+        # stays in memory, the store only spares the workers their copies.
+        # The last validation_split of the windows validate, as with
+        # model.fit(validation_split=..., shuffle=False).
+        from week6.abi.solution_scripts import feeders
+        features_path = os.path.join(store_dir, 'lstm_features.npy')
+        targets_path = os.path.join(store_dir, 'lstm_targets.npy')
+        order, starts = window_layout(self.get_groups(self.train_var), len(self.train_var), time_steps)
+        feeders.write_feature_store(self.train_var, features_path, order)
+        feeders.write_feature_store(self.train_var[self.output_column], targets_path, order)
+        split = int(len(starts) * (1 - validation_split))
+        train_data = feeders.WindowSequence(features_path, targets_path, starts[:split], time_steps, batch_size)
+        val_data = feeders.WindowSequence(features_path, targets_path, starts[split:], time_steps, batch_size)
+        return train_data, val_data
+
+    def train(self, hparams, filename, streaming=False, workers=1, prefetch=10, use_cache=True, metrics_port=None):
+        # streaming=True feeds the model from a memory-mapped store in
+        # filename/feature_store with `workers` processes (see get_sequences).
+        # The store is written from train_var, so the training data must
+        # still fit in memory: streaming saves the windowed copy and the
+        # workers' copies, it does not train on data larger than RAM.
+        # With use_cache a model trained before on the same data, hparams and
+        # architecture comes from the model store instead of being retrained.
+        # Per-epoch timings are appended to the history csv while training
+        # runs and, with metrics_port, served as Prometheus metrics.
+        from week6.abi.solution_scripts import model_store
+        time_steps = hparams["time_steps"]
+        input_shape = (time_steps, self.train_var.shape[1])
         #X_test, y_test = self.create_dataset(test, test[output_column], hparams["time_steps"])
         model = keras.Sequential()
         model.add(keras.layers.Bidirectional(
-            keras.layers.LSTM(units=hparams["neurons"], activation='relu', input_shape=(X_train.shape[1], X_train.shape[2]))))
+            keras.layers.LSTM(units=hparams["neurons"], activation='relu', input_shape=input_shape)))
         model.add(keras.layers.Dropout(rate=hparams["dropout"]))
         model.add(keras.layers.Dense(units=hparams["layers"]))
         optimizer = keras.optimizers.Adam(clipvalue=1.0, name='adam', learning_rate=hparams['lr'])
         model.compile(loss='mean_squared_error', optimizer=optimizer)
         #model.summary()
-        history = model.fit(X_train, y_train, callbacks=self.get_callbacks(),
-        epochs=hparams["epochs"], batch_size=hparams["batch"], validation_split=0.2, shuffle=False)
-        hist_df = pd.DataFrame(history.history)
+        # train_var holds the output and group columns, which columns those
+        # are decides the windows
+        data = [model_store.frame_fingerprint(self.train_var), self.output_column, self.group_columns]
+        key = model_store.model_key(data, hparams, model_store.architecture(model))
+        cached = model_store.load(key) if use_cache else None
+        if cached is not None:
+            model, hist_df = cached
+        else:
+            from week6.abi.solution_scripts import instrumentation
+            if metrics_port is not None:
+                instrumentation.start_metrics_server(metrics_port)
+            hist_csv_file = f'{filename}/history_{hparams["neurons"]}.csv'
+            if streaming:
+                from week6.abi.solution_scripts import feeders
+                train_data, val_data = self.get_sequences(time_steps, hparams["batch"], f'{filename}/feature_store')
+                # batches cut in worker processes are not timed here
+                feed = None if feeders.fit_options(workers, prefetch)["use_multiprocessing"] else train_data
+                monitor = instrumentation.TrainingMonitor('LSTM', len(train_data.starts), hist_csv_file, feed)
+                history = model.fit(train_data, validation_data=val_data, callbacks=[monitor] + self.get_callbacks(),
+                epochs=hparams["epochs"], shuffle=False, **feeders.fit_options(workers, prefetch))
+            else:
+                train_data, val_data = self.get_windows(self.train_var, time_steps, hparams["batch"],
+                                                        validation_split=0.2)
+                monitor = instrumentation.TrainingMonitor('LSTM', len(train_data.starts), hist_csv_file, train_data)
+                history = model.fit(train_data, validation_data=val_data, callbacks=[monitor] + self.get_callbacks(),
+                epochs=hparams["epochs"], shuffle=False)
+            hist_df = pd.DataFrame(history.history)
+            model_store.save(key, model, hist_df)
         n = hparams["neurons"]
         hist_csv_file = f'{filename}/history_{n}.csv'
         with open(hist_csv_file, mode='w') as f:
@@ -84,11 +224,20 @@ class LSTM():
         
         return model, hist_df
 
-    def test(self, time_steps):
-        X_test, y_test = self.create_dataset(self.test_var, self.test_var[self.output_column], time_steps)
-        y_pred = self.model.predict(X_test)
+    def test(self, time_steps, batch_size=32):
+        test_data = self.get_windows(self.test_var, time_steps, batch_size)
+        y_test = test_data.targets[test_data.starts + time_steps]
+        y_pred = self.model.predict(test_data)
         return y_test, y_pred
 
+def fit_prophet(group, periods, freq):
+    # Module level so it can be sent to worker processes
+    m = fbprophet.Prophet()
+    m.fit(group)
+    future = m.make_future_dataframe(periods=periods, freq=freq)
+    return m.predict(future)
+
+
 class Facebook():
     def prepare(self, df, columns_to_remove, output_column, year_to_pred):
         data = df.drop(columns=columns_to_remove)
@@ -100,32 +249,115 @@ class Facebook():
         grouped = data.groupby(['Category Code'])
         return main_group, grouped
 
-    def predict(self, data,  columns_to_remove, output_column,periods=1, freq='Y', year_to_pred =2019):
-        final = pd.DataFrame()
-        predictions = pd.DataFrame(columns=list(['Time','group', 'y_true', 'y_pred', 'mae']))
+    def predict(self, data,  columns_to_remove, output_column,periods=1, freq='Y', year_to_pred =2019, n_jobs=1):
+        # n_jobs > 1 fits the groups in that many processes (-1: one per core).
+        # Results keep the order of grouped.groups whatever order the fits
+        # finish in. A group whose fit raises is left out of the results and
+        # its error is kept in self.failures.
         main_group, grouped = self.prepare(data, columns_to_remove, output_column, year_to_pred)
+        self.failures = {}
+        forecasts = self.fit_groups(grouped, periods, freq, n_jobs)
+        # One array per column and group, concatenated once at the end
+        columns = {'Time': [], 'group': [], 'y_true': [], 'y_pred': []}
+        yhats = []
         for g in grouped.groups:
-            group = grouped.get_group(g)
+            if g in self.failures:
+                continue
             curr = main_group.get_group(g)
-            y_true = curr[curr.index.year==year_to_pred][output_column].values
-            indexes = curr[curr.index.year==year_to_pred].index.values
-            #print(indexes)
-            #print(y_true[0])
-            m = Prophet()
-            m.fit(group)
-            future = m.make_future_dataframe(periods=periods, freq=freq)
-            forecast = m.predict(future)
+            y_true = curr[curr.index.year==year_to_pred][output_column].values[:12]
+            indexes = curr[curr.index.year==year_to_pred].index.values[:12]
+            forecast = forecasts[g]
             y_pred = forecast['yhat'].tail(12).values
-            for i in range(12):
-                mae = mean_absolute_error([y_true[i]], [y_pred[i]])
-                predictions = predictions.append({'Time':indexes[i] ,'group': str(g), 'y_true':y_true[i], 'y_pred':y_pred[i], 'mae':mae}, ignore_index=True)
-            #print('MAE: %.3f' % mae)
-            #print(forecast.tail())
-            forecast = forecast.rename(columns={'yhat': 'yhat_'+str(g)})
-            final = pd.merge(final, forecast.set_index('ds'), how='outer', left_index=True, right_index=True)
-        final = final[['yhat_' + str(g) for g in grouped.groups.keys()]]
+            columns['Time'].append(indexes)
+            columns['group'].append(np.repeat(str(g), len(indexes)))
+            columns['y_true'].append(y_true)
+            columns['y_pred'].append(y_pred)
+            yhats.append(forecast.set_index('ds')['yhat'].rename('yhat_'+str(g)))
+        predictions = pd.DataFrame({name: np.concatenate(parts) if parts else []
+                                    for name, parts in columns.items()})
+        # absolute error of every month, the MAE of a single prediction
+        predictions['mae'] = (predictions['y_true'] - predictions['y_pred']).abs()
+        final = pd.concat(yhats, axis=1).sort_index() if yhats else pd.DataFrame()
         return predictions, final
 
+    def fit_groups(self, grouped, periods, freq, n_jobs=1):
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+        forecasts = {}
+        if n_jobs is None or n_jobs <= 1:
+            for g in grouped.groups:
+                group = grouped.get_group(g)
+                try:
+                    forecasts[g] = fit_prophet(group, periods, freq)
+                except Exception as e:
+                    self.failures[g] = e
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = {g: executor.submit(fit_prophet, grouped.get_group(g), periods, freq)
+                           for g in grouped.groups}
+                for g, future in futures.items():
+                    try:
+                        forecasts[g] = future.result()
+                    except Exception as e:
+                        self.failures[g] = e
+        for g, e in self.failures.items():
+            warnings.warn(f"Prophet fit failed for group {g}: {e!r}")
+        return forecasts
+
+def pruning_callback(trial, monitor='val_loss'):
+    # Reports val_loss to the optuna trial after every epoch and stops the
+    # trial when the pruner says so
+    def on_epoch_end(epoch, logs=None):
+        value = (logs or {}).get(monitor)
+        if value is None:
+            return
+        trial.report(float(value), step=epoch)
+        if trial.should_prune():
+            raise optuna.TrialPruned(f'Trial was pruned at epoch {epoch}.')
+    return keras.callbacks.LambdaCallback(on_epoch_end=on_epoch_end)
+
+
+def get_pruner():
+    return optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=3)
+
+
+def ann_objective(trial, trainX, trainY, valX, valY, epochs=15):
+    K.clear_session()
+    model = keras.Sequential()
+    neurons = 512
+    initializer = keras.initializers.HeNormal()
+    model.add(keras.layers.Dense(neurons, input_dim=trainX.shape[1], name='InputLayer', activation='relu', kernel_initializer=initializer))
+    model.add(keras.layers.BatchNormalization())
+    model.add(keras.layers.Dropout(rate=0.36))
+
+    neurons = neurons/2
+    model.add(keras.layers.Dense(neurons, kernel_initializer=initializer, activation='relu', name='H1'))
+    model.add(keras.layers.BatchNormalization())
+    model.add(keras.layers.Dropout(rate=0.37))
+
+    neurons = neurons/2
+    model.add(keras.layers.Dense(neurons, kernel_initializer=initializer, activation='relu', name='H2'))
+    model.add(keras.layers.BatchNormalization())
+    model.add(keras.layers.Dropout(rate=0.16))
+
+    model.add(keras.layers.Dense(neurons, kernel_initializer=initializer, activation='relu', name='H3'))
+    model.add(keras.layers.Dense(1, activation='linear', name="OutputLayer", kernel_initializer=initializer))
+    opt = tf.keras.optimizers.Adam(lr=trial.suggest_float('lr', 1e-5, 1e-3, log=True), decay=trial.suggest_float('decay', 1e-5, 0.1, log=True))
+    model.compile(loss='mae', optimizer=opt)
+    history = model.fit(x=trainX, y=trainY, validation_data=(valX, valY), epochs=epochs, verbose=2,
+                        batch_size=trial.suggest_int('batchsize',68, 512, step=12),
+                        callbacks=[pruning_callback(trial)])
+    return history.history["val_loss"][-1]
+
+
+def run_trials(study_name, storage, paths, n_trials, epochs):
+    # Worker of ANN.train_trials: maps the shared arrays and runs its share
+    # of the trials against the common study
+    trainX, trainY, valX, valY = [np.load(path, mmap_mode='r') for path in paths]
+    study = optuna.load_study(study_name=study_name, storage=storage, pruner=get_pruner())
+    study.optimize(lambda trial: ann_objective(trial, trainX, trainY, valX, valY, epochs), n_trials=n_trials)
+
+
 class ANN():
     def __init__(self, df, output_column, train_raw, val_raw, test_raw, continuous_cols):
         self.output_column = output_column
@@ -140,41 +372,46 @@ class ANN():
 
     def scale(self, train, test, val):
         #scale features
-        cs = RobustScaler()
+        cs = preprocessing.RobustScaler()
         
         return (trainX, valX, testX)
         
 
     def prepare(self):
-        self.cs = RobustScaler()
-        self.trainX = self.cs.fit_transform(self.train[self.continous])
-        self.valX = self.cs.transform(self.val[self.continous])
-        self.testX = self.cs.transform(self.test[self.continous])
+        # inputs and target get their own scaler, inference needs both
+        self.xs = preprocessing.RobustScaler()
+        self.trainX = self.xs.fit_transform(self.train[self.continous])
+        self.valX = self.xs.transform(self.val[self.continous])
+        self.testX = self.xs.transform(self.test[self.continous])
         #self.trainX, self.valX, self.testX = self.scale(self.train, self.test, self.val)
+        self.cs = preprocessing.RobustScaler()
         self.trainY = self.cs.fit_transform(self.train[[self.output_column]])
         self.testY = self.cs.transform(self.test[[self.output_column]])
         self.valY = self.cs.transform(self.val[[self.output_column]])
         return self.trainX, self.trainY, self.valX, self.valY
    
     def create_model(self,  neurons=256):
-        model = Sequential()
+        model = keras.Sequential()
         initializer = keras.initializers.HeNormal()
-        model.add(Dense(neurons, input_dim=self.trainX.shape[1], name='InputLayer', activation='relu', kernel_initializer=initializer))
+        model.add(keras.layers.Dense(neurons, input_dim=self.trainX.shape[1], name='InputLayer', activation='relu', kernel_initializer=initializer))
         model.add(keras.layers.BatchNormalization())
         model.add(keras.layers.Dropout(rate=0.36))
         
         neurons = neurons/2
-        model.add(Dense(neurons, kernel_initializer=initializer, activation='relu', name='H1'))
+        model.add(keras.layers.Dense(neurons, kernel_initializer=initializer, activation='relu', name='H1'))
         model.add(keras.layers.BatchNormalization())
         model.add(keras.layers.Dropout(rate=0.37))
         
         neurons = neurons/2
-        model.add(Dense(neurons, kernel_initializer=initializer, activation='relu', name='H2'))
+        model.add(keras.layers.Dense(neurons, kernel_initializer=initializer, activation='relu', name='H2'))
         model.add(keras.layers.BatchNormalization())
         model.add(keras.layers.Dropout(rate=0.16))
         
-        model.add(Dense(1, activation='linear', name="OutputLayer", kernel_initializer=initializer))
+        model.add(keras.layers.Dense(1, activation='linear', name="OutputLayer", kernel_initializer=initializer))
         self.model = model
+        # train_model continues training a fitted model instead of using the
+        # model store
+        self.fitted = False
         return model
     def get_callbacks(self):
         return[
@@ -182,50 +419,52 @@ class ANN():
             keras.callbacks.History()
         ]
 
-    def train_trials(self, n_trials):
-        study = optuna.create_study()
-        study.optimize(self.objective, n_trials=n_trials)
-        return study.best_params
-
-    def objective(self, trial):
-        K.clear_session()
-        model = Sequential()
-        neurons = 512
-        initializer = keras.initializers.HeNormal()
-        initializer = keras.initializers.HeNormal()
-        model.add(Dense(neurons, input_dim=self.trainX.shape[1], name='InputLayer', activation='relu', kernel_initializer=initializer))
-        model.add(keras.layers.BatchNormalization())
-        model.add(keras.layers.Dropout(rate=0.36))
-        
-        neurons = neurons/2
-        model.add(Dense(neurons, kernel_initializer=initializer, activation='relu', name='H1'))
-        model.add(keras.layers.BatchNormalization())
-        model.add(keras.layers.Dropout(rate=0.37))
-        
-        neurons = neurons/2
-        model.add(Dense(neurons, kernel_initializer=initializer, activation='relu', name='H2'))
-        model.add(keras.layers.BatchNormalization())
-        model.add(keras.layers.Dropout(rate=0.16))
-        
-        model.add(Dense(neurons, kernel_initializer=initializer, activation='relu', name='H3'))
-        model.add(Dense(1, activation='linear', name="OutputLayer", kernel_initializer=initializer))
-        trainY= self.trainY
-        testY =self.testY
-        trainX = self.trainX
-        model = self.model
-        opt = Adam(lr=trial.suggest_float('lr', 1e-5, 1e-3, log=True), decay=trial.suggest_float('decay', 1e-5, 0.1, log=True))
-        model.compile(loss='mae', optimizer=opt)
-        history = model.fit(x=trainX, y=trainY, validation_data=(self.valX, self.valY), epochs=15, verbose=2,
-                            batch_size=trial.suggest_int('batchsize',68, 512, step=12))
-        return history.history["val_loss"][-1]
-       
-        
+    def train_trials(self, n_trials, n_jobs=1, epochs=15, storage=None, study_name='ann', store_dir='optuna'):
+        # n_jobs > 1 runs the trials in that many processes sharing one study
+        # in a SQLite file (store_dir/optuna.db unless `storage` is given).
+        # The workers read the prepared arrays from memory-mapped copies in
+        # store_dir instead of each receiving its own. Trials whose val_loss
+        # falls behind the median of the others at the same epoch are pruned.
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+        if n_jobs is None or n_jobs <= 1:
+            study = optuna.create_study(study_name=study_name, storage=storage, load_if_exists=True,
+                                        pruner=get_pruner())
+            study.optimize(lambda trial: self.objective(trial, epochs), n_trials=n_trials)
+            return study.best_params
+        from week6.abi.solution_scripts import feeders
+        os.makedirs(store_dir, exist_ok=True)
+        if storage is None:
+            storage = f'sqlite:///{store_dir}/optuna.db'
+        paths = []
+        for name, array in (('trainX', self.trainX), ('trainY', self.trainY), ('valX', self.valX), ('valY', self.valY)):
+            path = os.path.join(store_dir, f'{name}.npy')
+            feeders.write_feature_store(array, path)
+            paths.append(path)
+        study = optuna.create_study(study_name=study_name, storage=storage, load_if_exists=True,
+                                    pruner=get_pruner())
+        # TensorFlow does not survive fork, the workers start fresh
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context) as executor:
+            futures = [executor.submit(run_trials, study_name, storage, paths, n, epochs)
+                       for n in np.diff(np.linspace(0, n_trials, n_jobs + 1).astype(int)) if n]
+            for future in futures:
+                future.result()
+        return optuna.load_study(study_name=study_name, storage=storage).best_params
 
-    
+    def objective(self, trial, epochs=15):
+        return ann_objective(trial, self.trainX, self.trainY, self.valX, self.valY, epochs)
 
-    
-    def train_model(self, hparams, filename, historyname):
-        opt = Adam(lr=hparams['lr'], decay=hparams['decay_rate'])
+    def train_model(self, hparams, filename, historyname, use_cache=True, metrics_port=None):
+        # With use_cache a model trained before on the same data, hparams and
+        # architecture comes from the model store instead of being retrained.
+        # A model that was already fitted (train_model called again without
+        # create_model) keeps training from its weights and is not stored.
+        # Trains from the in-memory trainX/valX, there is no streaming mode.
+        # Per-epoch timings are appended to the history csv while training
+        # runs and, with metrics_port, served as Prometheus metrics.
+        from week6.abi.solution_scripts import model_store
+        opt = tf.keras.optimizers.Adam(lr=hparams['lr'], decay=hparams['decay_rate'])
         #opt = tfa.optimizers.MovingAverage(opt)
         #keras.backend.set_epsilon(1e-7)
         print("[INFO] processing data")
@@ -235,16 +474,34 @@ class ANN():
         model = self.model
         model.compile(loss='mae', optimizer=opt, metrics=[root_mean_squared_error])
         model.summary()
-        print("[INFO] training model...")
-        history = model.fit(x=trainX, y=trainY, validation_data=(self.valX, self.valY), verbose=2,
-	                epochs=hparams["epochs"], batch_size=hparams["batch"], callbacks=self.get_callbacks())
+        fitted = getattr(self, 'fitted', False)
+        key = model_store.model_key(model_store.fingerprint(trainX, trainY, self.valX, self.valY), hparams,
+                                    model_store.architecture(model))
+        custom_objects = {'root_mean_squared_error': root_mean_squared_error}
+        cached = model_store.load(key, custom_objects) if use_cache and not fitted else None
+        if cached is not None:
+            print("[INFO] loading trained model from the model store...")
+            model, hist_df = cached
+            history = keras.callbacks.History()
+            history.history = hist_df.to_dict('list')
+        else:
+            print("[INFO] training model...")
+            from week6.abi.solution_scripts import instrumentation
+            if metrics_port is not None:
+                instrumentation.start_metrics_server(metrics_port)
+            monitor = instrumentation.TrainingMonitor('ANN', len(trainX), f'{filename}/{historyname}.csv')
+            history = model.fit(x=trainX, y=trainY, validation_data=(self.valX, self.valY), verbose=2,
+                    epochs=hparams["epochs"], batch_size=hparams["batch"], callbacks=[monitor] + self.get_callbacks())
+            if not fitted:
+                model_store.save(key, model, pd.DataFrame(history.history))
         model.save(filename)
         hist_df = pd.DataFrame(history.history)
         hist_csv_file = f'{filename}/{historyname}.csv'
         with open(hist_csv_file, mode='w') as f:
           hist_df.to_csv(f)
         self.model = model
-        plot_model(model, to_file=f'{filename}/model_archi.png', show_shapes=True, show_layer_names=True)
+        self.fitted = True
+        vis_utils.plot_model(model, to_file=f'{filename}/model_archi.png', show_shapes=True, show_layer_names=True)
         return history, model
         
     def predict(self):
@@ -267,9 +524,85 @@ class ANN():
 	        locale.currency(df[self.output_column].std(), grouping=True)))
         print("[INFO] mean: {:.2f}%, std: {:.2f}%".format(mean, std))
         return self.cs.inverse_transform(preds)
+
+    def export(self, path):
+        # TensorFlow free copy of the trained model, see inference.NumpyANN
+        from week6.abi.solution_scripts import inference
+        inference.export_ann(self.model, self.xs, self.cs, path)
         
 
 
+def var_group(group):
+    # Columns a per-group VAR is fitted on: no Reporter, no constant series
+    group = group.drop(columns={'Reporter'})
+    return group.loc[:, (group != group.iloc[0]).any()]
+
+
+def fit_var(group, opt_lag):
+    # Module level so it can be sent to worker processes
+    result = tsa_api.VAR(group).fit(maxlags=opt_lag, ic='aic', trend='c')
+    return result, stats_stattools.durbin_watson(result.resid)
+
+
+def lag_order_table(values, maxlags):
+    # AIC/BIC/FPE/HQIC of VAR(p) with a constant for p = 0..maxlags, all on
+    # the sample left after maxlags lags, like VAR.select_order. The lagged
+    # design matrix is built and factorized once: VAR(p) uses its first
+    # 1 + p*K columns, so with Z = QR the residual sum of squares of every p
+    # follows from the leading columns of Q'Y.
+    y = np.asarray(values, dtype=float)
+    k = y.shape[1]
+    nobs = len(y) - maxlags
+    Y = y[maxlags:]
+    Z = np.hstack([np.ones((nobs, 1))] + [y[maxlags - lag:len(y) - lag] for lag in range(1, maxlags + 1)])
+    q, _ = np.linalg.qr(Z)
+    qty = q.T @ Y
+    yty = Y.T @ Y
+    rows = []
+    for p in range(maxlags + 1):
+        df_model = 1 + p * k
+        df_resid = nobs - df_model
+        fitted = qty[:df_model]
+        sigma = (yty - fitted.T @ fitted) / nobs
+        free_params = k * df_model
+        ld = np.linalg.slogdet(sigma)[1] if df_resid > 0 else -np.inf
+        fpe = ((nobs + df_model) / df_resid) ** k * np.exp(ld) if df_resid > 0 else np.inf
+        rows.append({
+            'aic': ld + 2.0 / nobs * free_params,
+            'bic': ld + np.log(nobs) / nobs * free_params,
+            'fpe': fpe,
+            'hqic': ld + 2.0 * np.log(np.log(nobs)) / nobs * free_params,
+        })
+    return pd.DataFrame(rows, index=pd.RangeIndex(maxlags + 1, name='lag'))
+
+
+def forecast_batch(results, inputs, steps):
+    # Forecasts of every fitted VAR (trend='c') at once. The coefficients
+    # are stacked into (groups, max lag, max vars, max vars) with zero
+    # padding, which leaves the padded lags and variables without effect,
+    # and the recursion runs for all groups with one einsum per step.
+    # inputs[g] holds at least the last k_ar observations of group g.
+    # Returns (groups, steps, max vars), group g's columns first.
+    n_vars = max(result.neqs for result in results)
+    n_lags = max(max(result.k_ar for result in results), 1)
+    coefs = np.zeros((len(results), n_lags, n_vars, n_vars))
+    intercepts = np.zeros((len(results), n_vars))
+    history = np.zeros((len(results), n_lags, n_vars))
+    for g, (result, values) in enumerate(zip(results, inputs)):
+        k, p = result.neqs, result.k_ar
+        coefs[g, :p, :k, :k] = result.coefs
+        intercepts[g, :k] = np.asarray(result.params)[0]
+        if p:
+            # most recent observation first, like the lags in coefs
+            history[g, :p, :k] = np.asarray(values, dtype=float)[-p:][::-1]
+    forecasts = np.empty((len(results), steps, n_vars))
+    for step in range(steps):
+        y = intercepts + np.einsum('gpij,gpj->gi', coefs, history)
+        forecasts[:, step] = y
+        history = np.concatenate([y[:, None], history[:, :-1]], axis=1)
+    return forecasts
+
+
 class VAR():
     def __init__(self, df, output_column, columns_to_drop=None):
         self.df = df
@@ -288,7 +621,7 @@ class VAR():
         return train, test
 
     def adf_test(self, ts, signif=0.05):
-        dftest = adfuller(ts, autolag='AIC')
+        dftest = tsa_stattools.adfuller(ts, autolag='AIC')
         adf = pd.Series(dftest[0:4], index=['Test Statistic','p-value','# Lags','# Observations'])
         for key,value in dftest[4].items():
             adf['Critical Value (%s)'%key] = value
@@ -303,50 +636,50 @@ class VAR():
         train_var = self.train_var
         grouped = train_var.groupby(['Category Code'])
         group = grouped.get_group(next(iter(grouped.groups)))
-        group = group.drop(columns={'Category Code'})
-        model = var(group)
-        x = model.select_order(maxlags=max(lags))
-        print(x.summary())
+        group = group.drop(columns={'Category Code', 'Reporter'})
+        table = lag_order_table(group.values, max(lags))
+        print(table)
         for i in lags:
-            result = model.fit(i)
             print('Lag Order =', i)
-            print('AIC : ', result.aic)
-            print('BIC : ', result.bic)
-            print('FPE : ', result.fpe)
-            print('HQIC: ', result.hqic, '\n')
+            print('AIC : ', table.loc[i, 'aic'])
+            print('BIC : ', table.loc[i, 'bic'])
+            print('FPE : ', table.loc[i, 'fpe'])
+            print('HQIC: ', table.loc[i, 'hqic'], '\n')
+        return table
 
-    def train(self, opt_lag, grouped):
-        train_var = self.train_var
+    def train(self, opt_lag, grouped, n_jobs=1):
+        # n_jobs > 1 fits the groups in that many processes (-1: one per core)
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+        groups = {g: var_group(grouped.get_group(g)) for g in grouped.groups}
+        if n_jobs is None or n_jobs <= 1:
+            fits = {g: fit_var(group, opt_lag) for g, group in groups.items()}
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = {g: executor.submit(fit_var, group, opt_lag) for g, group in groups.items()}
+                fits = {g: future.result() for g, future in futures.items()}
         train_results = {}
-        for g in grouped.groups:
-            group = grouped.get_group(g)
-            group = group.drop(columns={'Reporter'})
-            group = group.loc[:, (group != group.iloc[0]).any()]
-            model = var(group)
-            result = model.fit(maxlags=opt_lag, ic='aic',trend='c')
+        for g, (result, out) in fits.items():
             train_results[g] = result
-            out = durbin_watson(result.resid)
-            for col, val in zip(group.columns, out):
+            for col, val in zip(groups[g].columns, out):
                 print((col), ':', round(val, 2))
 
         return train_results
 
     def forecast(self, steps, grouped_train, grouped_test, train_results, products_mapping):
-        forecasts = pd.DataFrame()
-        test_var = self.test_var
+        forecasts = []
         unique_index = grouped_test.get_group(next(iter(grouped_test.groups))).index.unique()
-        for key, value in train_results.items():
-            lag_order = value.k_ar
-            group = grouped_train.get_group(key)
-            group = group.drop(columns={'Reporter'})
-            group = group.loc[:, (group != group.iloc[0]).any()]
-            test_group = grouped_test.get_group(key)
-            forecast_input = group.values[-lag_order:]
-            fc = value.forecast(y=forecast_input, steps=steps)
+        keys = list(train_results)
+        groups = [var_group(grouped_train.get_group(key)) for key in keys]
+        results = [train_results[key] for key in keys]
+        fcs = forecast_batch(results, [group.values for group in groups], steps) if keys else []
+        for key, group, fc in zip(keys, groups, fcs):
+            lag_order = train_results[key].k_ar
             index = unique_index[:lag_order].values.tolist()
-            df_forecast = pd.DataFrame(fc, index=index, columns=group.columns)
+            df_forecast = pd.DataFrame(fc[:, :group.shape[1]], index=index, columns=group.columns)
             df_forecast['Product'] = products_mapping[str(key)]
-            forecasts = forecasts.append(df_forecast)
+            forecasts.append(df_forecast)
+        forecasts = pd.concat(forecasts, sort=False) if forecasts else pd.DataFrame()
 
         return forecasts
 
@@ -1,9 +1,14 @@
 
 import os, sys
+import warnings
 from customscripts import configuration
 from customscripts import utils
+from customscripts import reference
+from week6.abi.solution_scripts import pipeline
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 from sklearn.preprocessing import MinMaxScaler
 import matplotlib.pyplot as plt
 from matplotlib import rc
@@ -12,13 +17,49 @@ import tensorflow as tf
 from tensorflow import keras
 
 
+ANNUAL_YEARS = [2009, 2010, 2011, 2012, 2013, 2014, 2015, 2016, 2017, 2018, 2019]
+
+
+def save_period_indexed(df, path):
+    data = df.copy()
+    data.index = data.index.to_timestamp()
+    data.reset_index().to_parquet(path)
+
+
+def load_period_indexed(path):
+    data = pd.read_parquet(path).set_index("Time")
+    data.index = data.index.to_period('M')
+    return data
+
+
 class DataWrangling():
     def __init__(self, weeknumber, main_file, unneeded_columns = None):
-        self.main_data = utils.get_dataset_df(weeknumber, main_file)
-        self.gdp_data = utils.get_dataset_df(4, "gdp")
-        self.population_data = utils.get_dataset_df(4, "population")
-        self.population_data['Country Code'] = np.where(self.population_data['Country Code']=='DEU', 'GER', self.population_data['Country Code'])
-        self.gdp_data['Country Code'] = np.where(self.gdp_data['Country Code']=='DEU', 'GER', self.gdp_data['Country Code'])
+        # The tables are read on first use, so a run served from the stage
+        # cache never parses them
+        self.weeknumber = weeknumber
+        self.main_file = main_file
+        self._main_data = None
+
+    @property
+    def main_data(self):
+        if self._main_data is None:
+            self._main_data = utils.get_dataset_df(self.weeknumber, self.main_file)
+        return self._main_data
+
+    @main_data.setter
+    def main_data(self, value):
+        self._main_data = value
+
+    @property
+    def gdp_data(self):
+        # Shared by all instances through the reference registry, with
+        # DEU already renamed to GER
+        return reference.get_frame("gdp")
+
+    @property
+    def population_data(self):
+        return reference.get_frame("population")
+
     #def __init__(self, weeknumber, main_file, unneeded_columns):
     #    self.week_data = utils.get_dataset_df(weeknumber, main_file)
     #    
@@ -35,35 +76,78 @@ class DataWrangling():
     #    self.population_data = utils.get_dataset_df(4, "population")
     #    self.main_data = self.week_data.copy()
     def wrangle_step1(self):
-        countries = self.main_data["Reporter"].unique().tolist()
-        gdp_data = self.gdp_data[~(self.gdp_data.Year < 2009)]
-        gdp_data = self.gdp_data[~(self.gdp_data.Year == 2020)]
-        gdp_data = gdp_data[gdp_data["Country Code"].isin(countries)]
-        population_data = self.population_data[self.population_data["Country Code"].isin(countries)]
-        population_data = population_data[population_data.columns[~(population_data.columns < "2009")]]
-        population_data = population_data.drop(columns={"2020", "Unnamed: 65"})
-        #gdp_data = gdp_data.drop(columns={"2020"})
-        main_data = self.main_data
+        gdp_table, population_table = self.get_annual_tables()
+        main_data = self.enrich(self.main_data, gdp_table, population_table)
+        self.main_data = main_data
+        return main_data
+
+    def get_annual_tables(self):
+        # GDP for every year but 2020, population for 2009-2019. The dense
+        # tables come from the registry, only the year subsets are new.
+        gdp_table = reference.get_table("gdp")
+        gdp_table = gdp_table.restrict(year for year in gdp_table.years if year != 2020)
+        population_table = reference.get_table("population").restrict(ANNUAL_YEARS)
+        return gdp_table, population_table
+
+    def enrich(self, main_data, gdp_table, population_table):
         main_data = main_data[~main_data['Time'].isnull()]
         #main_data['Partner ISO'].fillna(main_data.Partner, inplace=True)
-        years = [2009, 2010, 2011, 2012, 2013, 2014, 2015, 2016, 2017, 2018, 2019]
-
         gdpColumnName = 'Gdp_per_capita'
         populationColumnName = "Population"
         main_data['Time'] = pd.to_datetime(main_data['Time'], format="%Y-%m-%d")
-        main_data = self.merge_annual_data_columnwise(main_data.copy(), gdp_data, years, gdpColumnName)
-        main_data = self.merge_annual_data_rowwise(main_data.copy(), population_data, years, populationColumnName)
-        self.main_data = main_data
+        # The filtered frame is already a copy, the columns are added in place
+        main_data = self.attach_annual(main_data, gdp_table, gdpColumnName, missing=0.0)
+        main_data = self.attach_annual(main_data, population_table, populationColumnName, missing=np.nan, report=True)
         return main_data
 
+    def attach_annual(self, df, table, new_col_name, missing=0.0, report=False):
+        # One gather per row from the dense (country, year) table. Rows
+        # without a value get `missing`; with `report` they are also listed
+        # in a warning.
+        values, matched = table.lookup(df['Reporter'], df['Time'].dt.year)
+        values[~matched] = missing
+        if report and not matched.all():
+            unmatched = df.loc[~matched, 'Reporter'].astype(str).unique().tolist()
+            warnings.warn(f"{new_col_name}: no value for {(~matched).sum()} rows, reporters {sorted(unmatched)}")
+        df[new_col_name] = values
+        return df
+
+    def get_stages(self, columns_to_drop=None, needed_flow=None, product_to_remove=None):
+        # step1 depends on the content of the three source tables, step2 on
+        # step1 and its parameters
+        sources = (utils.get_dataset_sources(self.weeknumber, self.main_file)
+                   + utils.get_dataset_sources(4, "gdp")
+                   + utils.get_dataset_sources(4, "population"))
+        step1 = pipeline.Stage(f"week{self.weeknumber}_{self.main_file}_step1", self.wrangle_step1, files=sources,
+                               code=[self.wrangle_step1, self.get_annual_tables, self.enrich,
+                                     self.attach_annual, reference])
+        step2 = pipeline.Stage(f"week{self.weeknumber}_{self.main_file}_step2", self._run_step2, inputs=[step1],
+                               params={"columns_to_drop": columns_to_drop, "needed_flow": needed_flow,
+                                       "product_to_remove": product_to_remove},
+                               save=save_period_indexed, load=load_period_indexed,
+                               code=[self.wrangle_step2, self.normalize])
+        return step1, step2
+
+    def _run_step2(self, main_data, **params):
+        self.main_data = main_data
+        return self.wrangle_step2(**params)
+
+    def wrangle(self, columns_to_drop=None, needed_flow=None, product_to_remove=None):
+        # wrangle_step1 + wrangle_step2, loading each step from the stage
+        # cache when its inputs and parameters are unchanged
+        _, step2 = self.get_stages(columns_to_drop, needed_flow, product_to_remove)
+        return step2.run()
+
     def wrangle_step2(self, columns_to_drop=None, needed_flow=None, product_to_remove=None):
+        return self.normalize(self.main_data, columns_to_drop, needed_flow, product_to_remove)
+
+    def normalize(self, data, columns_to_drop=None, needed_flow=None, product_to_remove=None):
         gdpColumnName = 'Gdp_per_capita'
         populationColumnName = "Population"
-        data_all_cats = self.main_data.copy()
-        data_all_cats=data_all_cats[~(data_all_cats.Time<"2009")]
+        data_all_cats = data[~(data.Time<"2009")]
         
         #print(f'Unique Times {data_all_cats["Time"].unique()}')
-        data_all_cats.sort_values(by=['Time', 'Reporter'], inplace=True)
+        data_all_cats = data_all_cats.sort_values(by=['Time', 'Reporter'])
         norm_trade_col = 'Trade_val_per_capita'
         #norm_gdp_col = 'log (GDP) p/c'
         data_all_cats[norm_trade_col] = data_all_cats['Trade Value (US$)']/data_all_cats['Population']
@@ -78,33 +162,32 @@ class DataWrangling():
         data_all_cats.index = data_all_cats.index.to_period('M')
         return data_all_cats
 
-
+    def wrangle_chunked(self, output_dir, chunksize=500000, columns_to_drop=None, needed_flow=None,
+                        product_to_remove=None, partition_cols=("Reporter",)):
+        # Same result as wrangle_step1 + wrangle_step2, but the main table is
+        # streamed in batches of `chunksize` rows and every batch is appended
+        # to a Parquet dataset under output_dir partitioned by partition_cols,
+        # so peak memory depends on the chunk size, not the file size. Rows
+        # are sorted by Time and Reporter inside each batch only. Time is
+        # stored as a timestamp, see load_period_indexed for the PeriodIndex.
+        gdp_table, population_table = self.get_annual_tables()
+        written = 0
+        for chunk in utils.iter_dataset_chunks(self.weeknumber, self.main_file, chunksize):
+            enriched = self.enrich(chunk, gdp_table, population_table)
+            normalized = self.normalize(enriched, columns_to_drop, needed_flow, product_to_remove)
+            if normalized.empty:
+                continue
+            normalized.index = normalized.index.to_timestamp()
+            table = pa.Table.from_pandas(normalized.reset_index(), preserve_index=False)
+            pq.write_to_dataset(table, output_dir, partition_cols=list(partition_cols))
+            written += len(normalized)
+        return written
 
     def merge_annual_data_columnwise(self, df, data, years, new_col_name):
-        df[new_col_name] = 0.0
-        #df['Year'] = df['Year'].astype('str') 
-        for index, row in data.iterrows():
-            val = int(row['Year'])
-            country = str(row['Country Code'])
-            df[new_col_name] = np.where((df['Time'].dt.year ==val) & (df['Reporter'] == country), row['Value'], df[new_col_name])
-        return df
+        # data is long, one (Year, Country Code, Value) row per country and year
+        return self.attach_annual(df, reference.ReferenceTable.from_long(data), new_col_name, missing=0.0)
 
     def merge_annual_data_rowwise(self, df, data, years, new_col_name):
-        df[new_col_name] = 0.0
-        #df['Year'] = df['Year'].astype('str') 
-        for index,row in data.iterrows():
-            country = str(row["Country Code"])
-            for i, val in enumerate(years):
-                val = int(val)
-                df[new_col_name] = np.where((df['Time'].dt.year ==val) & (df['Reporter'] == country), row[str(val)], df[new_col_name])
-        return df
-
-
-
-
-
-
-
-
-
-
+        # data is wide, one row per country and one column per year
+        table = reference.ReferenceTable.from_wide(data, years=years)
+        return self.attach_annual(df, table, new_col_name, missing=np.nan, report=True)
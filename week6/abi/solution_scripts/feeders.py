@@ -0,0 +1,102 @@
+import math
+import os
+import time
+
+import numpy as np
+import keras
+
+
+def write_feature_store(source, path, rows=None, chunk_rows=65536):
+    # Writes the rows of source (array or DataFrame), or source[rows] in that
+    # order, to a float32 .npy and returns a read-only memory map on it. The
+    # rows are converted chunk_rows at a time straight into the file, so
+    # neither the float32 copy nor the reordered copy ever exists in memory.
+    # Training then pages in only the rows a batch touches and worker
+    # processes share the file instead of each getting a copy. source itself
+    # is still in memory: the store does not make data larger than RAM
+    # trainable.
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    n = len(source) if rows is None else len(rows)
+    store = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(n,) + np.shape(source)[1:])
+    for i in range(0, n, chunk_rows):
+        chunk = slice(i, i + chunk_rows) if rows is None else rows[i:i + chunk_rows]
+        if hasattr(source, "iloc"):
+            store[i:i + chunk_rows] = source.iloc[chunk].to_numpy(dtype=np.float32)
+        else:
+            store[i:i + chunk_rows] = source[chunk]
+    store.flush()
+    del store
+    return np.load(path, mmap_mode="r")
+
+
+class _StoreSequence(keras.utils.Sequence):
+    # features and targets are arrays, or paths of .npy stores. Stores are
+    # opened lazily, so every worker process maps the files itself instead of
+    # receiving a pickled copy of the data.
+    def __init__(self, features, targets, batch_size):
+        super().__init__()
+        self.features_path = features if isinstance(features, str) else None
+        self.targets_path = targets if isinstance(targets, str) else None
+        self.batch_size = batch_size
+        self._features = None if self.features_path else features
+        self._targets = None if self.targets_path else targets
+        # time spent cutting batches in this process, see TrainingMonitor
+        self.feed_seconds = 0.0
+
+    @property
+    def features(self):
+        if self._features is None:
+            self._features = np.load(self.features_path, mmap_mode="r")
+        return self._features
+
+    @property
+    def targets(self):
+        if self._targets is None:
+            self._targets = np.load(self.targets_path, mmap_mode="r")
+        return self._targets
+
+    def __getitem__(self, index):
+        start = time.perf_counter()
+        batch = self.get_batch(index)
+        self.feed_seconds += time.perf_counter() - start
+        return batch
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.features_path:
+            state["_features"] = None
+        if self.targets_path:
+            state["_targets"] = None
+        return state
+
+
+class WindowSequence(_StoreSequence):
+    # Batches of (batch, time_steps, features) windows for the LSTM, cut from
+    # the features on demand so only one batch of windows exists at a time.
+    # `starts` are the first rows of the windows to serve (see
+    # Networks.window_layout), the target of the window starting at i is
+    # row i + time_steps.
+    def __init__(self, features, targets, starts, time_steps, batch_size):
+        super().__init__(features, targets, batch_size)
+        self.starts = np.asarray(starts)
+        self.time_steps = time_steps
+        self._offsets = np.arange(time_steps)
+
+    def __len__(self):
+        return math.ceil(len(self.starts) / self.batch_size)
+
+    def get_batch(self, index):
+        starts = self.starts[index * self.batch_size:(index + 1) * self.batch_size]
+        X = self.features[starts[:, None] + self._offsets]
+        y = self.targets[starts + self.time_steps]
+        return X, y
+
+
+def fit_options(workers=1, prefetch=10):
+    # model.fit arguments for feeding a Sequence from `workers` processes with
+    # up to `prefetch` batches queued ahead of the trainer
+    return {
+        "workers": workers,
+        "use_multiprocessing": workers > 1,
+        "max_queue_size": prefetch,
+    }
@@ -0,0 +1,91 @@
+import numpy as np
+
+# Scoring of exported ANN models with NumPy alone: importing this module does
+# not import TensorFlow or Keras, only export_ann needs the trained model.
+
+ACTIVATIONS = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0),
+    "sigmoid": lambda x: 1 / (1 + np.exp(-x)),
+    "tanh": np.tanh,
+}
+
+
+def _scaler_params(scaler, n):
+    # center_/scale_ of a fitted RobustScaler, identity where disabled
+    center = np.zeros(n) if getattr(scaler, "center_", None) is None else scaler.center_
+    scale = np.ones(n) if getattr(scaler, "scale_", None) is None else scaler.scale_
+    return np.asarray(center, dtype=float), np.asarray(scale, dtype=float)
+
+
+def export_ann(model, x_scaler, y_scaler, path):
+    # Writes a Dense/BatchNormalization/Dropout keras model to a .npz of
+    # plain affine layers. Dropout is the identity at inference. A
+    # BatchNormalization in inference mode is x * a + c per feature, which
+    # is folded into the weights of the next Dense; one with no Dense after
+    # it is kept as a diagonal layer.
+    weights, biases, activations = [], [], []
+    a, c = None, None
+    for layer in model.layers:
+        kind = type(layer).__name__
+        if kind == "Dropout":
+            continue
+        if kind == "Dense":
+            params = layer.get_weights()
+            W = params[0].astype(float)
+            b = params[1].astype(float) if len(params) > 1 else np.zeros(W.shape[1])
+            if a is not None:
+                b = b + c @ W
+                W = a[:, None] * W
+                a, c = None, None
+            weights.append(W)
+            biases.append(b)
+            activations.append(layer.get_config()["activation"])
+        elif kind == "BatchNormalization":
+            config = layer.get_config()
+            params = layer.get_weights()
+            gamma = params.pop(0) if config.get("scale", True) else 1.0
+            beta = params.pop(0) if config.get("center", True) else 0.0
+            mean, var = params
+            scale = gamma / np.sqrt(var + config["epsilon"])
+            shift = beta - mean * scale
+            # two norms in a row compose
+            a, c = (scale, shift) if a is None else (a * scale, c * scale + shift)
+        else:
+            raise ValueError(f"Cannot export layer {layer.name} of type {kind}")
+    if a is not None:
+        weights.append(np.diag(a))
+        biases.append(c)
+        activations.append("linear")
+    x_center, x_scale = _scaler_params(x_scaler, weights[0].shape[0])
+    y_center, y_scale = _scaler_params(y_scaler, weights[-1].shape[1])
+    arrays = {"x_center": x_center, "x_scale": x_scale, "y_center": y_center, "y_scale": y_scale,
+              "activations": np.array(activations)}
+    for i, (W, b) in enumerate(zip(weights, biases)):
+        arrays[f"W{i}"] = W
+        arrays[f"b{i}"] = b
+    np.savez_compressed(path, **arrays)
+
+
+class NumpyANN():
+    # Predictor for the .npz written by export_ann. predict takes the raw
+    # continuous columns and returns unscaled predictions, like ANN.predict.
+    def __init__(self, path, dtype=np.float32):
+        with np.load(path) as data:
+            self.activations = [ACTIVATIONS[name] for name in data["activations"]]
+            self.weights = [data[f"W{i}"].astype(dtype) for i in range(len(self.activations))]
+            self.biases = [data[f"b{i}"].astype(dtype) for i in range(len(self.activations))]
+            self.x_center, self.x_scale = data["x_center"], data["x_scale"]
+            self.y_center, self.y_scale = data["y_center"], data["y_scale"]
+        self.dtype = dtype
+
+    def predict_scaled(self, X):
+        # Network output for inputs scaled like ANN.trainX
+        out = np.asarray(X, dtype=self.dtype)
+        for W, b, activation in zip(self.weights, self.biases, self.activations):
+            out = activation(out @ W + b)
+        return out
+
+    def predict(self, X):
+        X = (np.asarray(X, dtype=float) - self.x_center) / self.x_scale
+        return self.predict_scaled(X) * self.y_scale + self.y_center
@@ -0,0 +1,82 @@
+import csv
+import os
+import time
+
+import keras
+from prometheus_client import Counter, Gauge, start_http_server
+
+from week6.abi.solution_scripts.memory_usage import peak_rss_bytes
+
+EPOCH_SECONDS = Gauge("training_epoch_seconds", "Wall time of the last epoch", ["model"])
+SAMPLES_PER_SECOND = Gauge("training_samples_per_second", "Training throughput of the last epoch", ["model"])
+PEAK_RSS_BYTES = Gauge("training_peak_rss_bytes", "Peak resident set size of the training process", ["model"])
+FEED_SECONDS = Counter("training_feed_seconds_total", "Time spent producing training batches", ["model"])
+EPOCHS = Counter("training_epochs_total", "Finished training epochs", ["model"])
+
+_servers = set()
+
+
+def start_metrics_server(port):
+    # Serves the metrics on http://localhost:<port>/metrics, once per port
+    if port not in _servers:
+        start_http_server(port)
+        _servers.add(port)
+
+
+class TrainingMonitor(keras.callbacks.Callback):
+    # Adds epoch_seconds, samples_per_second, peak_rss_mb and feed_seconds
+    # to the logs of every epoch, so they end up in model.fit's history next
+    # to the losses, and appends each epoch's row to history_path while
+    # training runs. feed_seconds is the time the training Sequence `feed`
+    # (see feeders) spent producing batches in this process. Keras fetches
+    # batches inside its train step, between the batch callbacks, so the
+    # callbacks cannot see that time themselves. Batches prefetched by a
+    # thread overlap with training, which makes feed_seconds an upper bound
+    # on the trainer's wait. It is NaN without a feed, or when the batches
+    # come from worker processes.
+    # The values are also exported as Prometheus metrics labelled `name`.
+    def __init__(self, name, samples_per_epoch, history_path=None, feed=None):
+        super().__init__()
+        self.model_name = name
+        self.samples_per_epoch = samples_per_epoch
+        self.history_path = history_path
+        self.feed = feed
+        self._fields = None
+
+    def on_train_begin(self, logs=None):
+        self._fields = None
+        if self.history_path is not None:
+            os.makedirs(os.path.dirname(self.history_path) or ".", exist_ok=True)
+            if os.path.exists(self.history_path):
+                os.remove(self.history_path)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch_start = time.perf_counter()
+        self._feed_start = self.feed.feed_seconds if self.feed is not None else None
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs if logs is not None else {}
+        seconds = time.perf_counter() - self._epoch_start
+        rss = peak_rss_bytes()
+        logs["epoch_seconds"] = seconds
+        logs["samples_per_second"] = self.samples_per_epoch / seconds if seconds else 0.0
+        logs["peak_rss_mb"] = rss / 1024 ** 2
+        feed = self.feed.feed_seconds - self._feed_start if self.feed is not None else float("nan")
+        logs["feed_seconds"] = feed
+        EPOCH_SECONDS.labels(self.model_name).set(seconds)
+        SAMPLES_PER_SECOND.labels(self.model_name).set(logs["samples_per_second"])
+        PEAK_RSS_BYTES.labels(self.model_name).set(rss)
+        if self.feed is not None:
+            FEED_SECONDS.labels(self.model_name).inc(feed)
+        EPOCHS.labels(self.model_name).inc()
+        if self.history_path is not None:
+            self._append(epoch, logs)
+
+    def _append(self, epoch, logs):
+        # Same layout as pd.DataFrame(history.history).to_csv()
+        if self._fields is None:
+            self._fields = list(logs)
+            with open(self.history_path, mode="w", newline="") as f:
+                csv.writer(f).writerow([""] + self._fields)
+        with open(self.history_path, mode="a", newline="") as f:
+            csv.writer(f).writerow([epoch] + [float(logs.get(field, float("nan"))) for field in self._fields])
@@ -0,0 +1,25 @@
+import sys
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+# Kept apart from instrumentation so measuring memory does not import keras
+# (see base_scripts/import_benchmark.py)
+
+
+def peak_rss_bytes():
+    # NaN where neither resource nor psutil is available
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+    try:
+        import psutil
+    except ImportError:
+        return float("nan")
+    info = psutil.Process().memory_info()
+    # peak working set on Windows
+    return getattr(info, "peak_wset", info.rss)
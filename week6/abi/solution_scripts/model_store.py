@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import keras
+import tensorflow as tf
+
+from customscripts import utils
+
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+settings = {
+    "store_dir": None,
+    "max_bytes": DEFAULT_MAX_BYTES,
+}
+
+
+def get_store_dir():
+    return settings["store_dir"] or f"{utils.get_dataset_dir()}/.cache/models"
+
+
+def fingerprint(*arrays):
+    # sha256 of the content, shape and dtype of the training arrays
+    digest = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(repr((array.shape, array.dtype.str)).encode())
+        digest.update(array.data)
+    return digest.hexdigest()
+
+
+def frame_fingerprint(df):
+    # sha256 of the columns, dtypes and content of a DataFrame, hashed a
+    # column at a time so no copy of the whole frame is made
+    digest = hashlib.sha256()
+    for i, col in enumerate(df.columns):
+        column = df.iloc[:, i]
+        digest.update(repr((col, str(column.dtype))).encode())
+        digest.update(pd.util.hash_pandas_object(column, index=False).to_numpy().data)
+    return digest.hexdigest()
+
+
+def _strip_names(config):
+    if isinstance(config, dict):
+        return {k: _strip_names(v) for k, v in config.items() if k != "name"}
+    if isinstance(config, list):
+        return [_strip_names(v) for v in config]
+    return config
+
+
+def architecture(model):
+    # The model config without layer names: keras numbers unnamed layers
+    # per session (dense_3...), which must not change the key
+    return json.dumps(_strip_names(model.get_config()), sort_keys=True, default=repr)
+
+
+def model_key(data_fingerprint, hparams, architecture):
+    # Trained weights depend on the data, the hyperparameters, the model
+    # definition (see architecture) and the library versions doing the work
+    parts = [
+        data_fingerprint,
+        sorted((k, repr(v)) for k, v in hparams.items()),
+        architecture,
+        [np.__version__, tf.__version__, keras.__version__],
+    ]
+    return hashlib.sha256(json.dumps(parts, default=repr).encode()).hexdigest()[:32]
+
+
+def _entry_dir(key):
+    return os.path.join(get_store_dir(), key)
+
+
+def load(key, custom_objects=None):
+    # (model, history frame) stored under key, None on a miss
+    entry = _entry_dir(key)
+    if not os.path.exists(os.path.join(entry, "history.csv")):
+        return None
+    model = keras.models.load_model(os.path.join(entry, "model"), custom_objects=custom_objects)
+    hist_df = pd.read_csv(os.path.join(entry, "history.csv"), index_col=0)
+    # the mtime of an entry is its recency for eviction
+    os.utime(entry)
+    return model, hist_df
+
+
+def save(key, model, hist_df):
+    entry = _entry_dir(key)
+    tmp_entry = f"{entry}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_entry, ignore_errors=True)
+    os.makedirs(tmp_entry)
+    model.save(os.path.join(tmp_entry, "model"))
+    # history.csv is written last, it marks a complete entry
+    hist_df.to_csv(os.path.join(tmp_entry, "history.csv"))
+    if os.path.exists(entry):
+        # another process stored the same key meanwhile
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+    else:
+        os.replace(tmp_entry, entry)
+    evict()
+
+
+def _entry_size(entry):
+    size = 0
+    for root, _, files in os.walk(entry):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def evict(max_bytes=None):
+    # Drops the least recently used entries until the store fits max_bytes
+    max_bytes = settings["max_bytes"] if max_bytes is None else max_bytes
+    store_dir = get_store_dir()
+    if not os.path.isdir(store_dir):
+        return
+    entries = []
+    for name in os.listdir(store_dir):
+        entry = os.path.join(store_dir, name)
+        if ".tmp-" in name or not os.path.isdir(entry):
+            continue
+        entries.append((os.path.getmtime(entry), _entry_size(entry), entry))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def clear():
+    shutil.rmtree(get_store_dir(), ignore_errors=True)
@@ -0,0 +1,117 @@
+import hashlib
+import inspect
+import json
+import os
+
+import pandas as pd
+
+from customscripts import loader_cache
+from customscripts import utils
+
+
+def get_stage_cache_dir():
+    return f"{utils.get_dataset_dir()}/.cache/stages"
+
+
+_file_hashes = {}
+
+
+def file_hash(path):
+    # sha256 of a file's content, or of every file below a directory. Hashing a
+    # multi-GB csv is slow, so hashes are remembered per (path, mtime, size),
+    # in memory and in hashes.json next to the cached stages.
+    fingerprint = loader_cache.fingerprint(path)
+    key = repr(fingerprint)
+    if key in _file_hashes:
+        return _file_hashes[key]
+    sidecar = os.path.join(get_stage_cache_dir(), "hashes.json")
+    stored = {}
+    if os.path.exists(sidecar):
+        with open(sidecar) as f:
+            stored = json.load(f)
+    if key not in stored:
+        digest = hashlib.sha256()
+        for file_path, _, _ in fingerprint:
+            if not os.path.isfile(file_path):
+                continue
+            with open(file_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+        stored[key] = digest.hexdigest()
+        os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+        with open(sidecar, "w") as f:
+            json.dump(stored, f)
+    _file_hashes[key] = stored[key]
+    return stored[key]
+
+
+def save_parquet(df, path):
+    df.to_parquet(path)
+
+
+def load_parquet(path):
+    return pd.read_parquet(path)
+
+
+class Stage():
+    # One step of a pipeline. `func` receives the outputs of `inputs` (other
+    # stages) in order, followed by `params` as keyword arguments. The output
+    # is persisted under a key derived from the content of `files`, the
+    # params, the code of `func` and the keys of the upstream stages, so a
+    # stage is recomputed only when something it depends on changed. When
+    # `func` is a thin wrapper, `code` lists the callables that do the work.
+    def __init__(self, name, func, inputs=(), files=(), params=None, save=save_parquet, load=load_parquet,
+                 code=None):
+        self.name = name
+        self.func = func
+        self.code = code or [func]
+        self.inputs = list(inputs)
+        self.files = list(files)
+        self.params = params or {}
+        self.save = save
+        self.load = load
+
+    def key(self):
+        code = []
+        for func in self.code:
+            try:
+                code.append(inspect.getsource(func))
+            except (OSError, TypeError):
+                code.append(getattr(func, "__qualname__", repr(func)))
+        parts = [
+            self.name,
+            code,
+            sorted((k, repr(v)) for k, v in self.params.items()),
+            [file_hash(path) for path in self.files if os.path.exists(path)],
+            [stage.key() for stage in self.inputs],
+        ]
+        return hashlib.sha256(repr(parts).encode()).hexdigest()[:32]
+
+    def path(self):
+        return os.path.join(get_stage_cache_dir(), f"{self.name}-{self.key()}.parquet")
+
+    def is_cached(self):
+        return os.path.exists(self.path())
+
+    def run(self):
+        # Upstream stages are only touched when this one has to recompute
+        path = self.path()
+        if os.path.exists(path):
+            return self.load(path)
+        inputs = [stage.run() for stage in self.inputs]
+        output = self.func(*inputs, **self.params)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        self.save(output, tmp_path)
+        os.replace(tmp_path, path)
+        return output
+
+
+def clear(name=None):
+    # Removes the persisted outputs, of every stage or of the stages called `name`
+    cache_dir = get_stage_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return
+    for file_name in os.listdir(cache_dir):
+        if file_name.endswith(".parquet") and (name is None or file_name.startswith(name + "-")):
+            os.remove(os.path.join(cache_dir, file_name))